@@ -0,0 +1,194 @@
+from core.database import Connection, Types
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+# benchmarks/database.py
+# - Times the table methods of core/database.py against synthetic databases of different sizes
+# - Run from the repository root: python -m benchmarks.database [--users 1000 100000 1000000] [--output results.jsonl]
+# - Results are JSON lines, pass an earlier results file with --compare to see what changed
+
+NOW = 1760000000  # Fixed so the same seed always builds the same database
+BADGES = 60
+QUESTS = 300
+BADGE_OWNERS = 0.05  # Share of users with at least one badge
+QUEST_USERS = 0.15  # Share of users who completed at least one quest
+
+def build(path: str, users: int, seed: int) -> None:
+	# Heavy tailed like the real tables: most users have little xp and no badges, a few have a lot
+	random.seed(seed)
+	connection = Connection(path)
+	connection.start()
+	ids = random.sample(range(10**17, 10**18), users)
+	with connection.transaction():
+		connection.users.create_many([Types.User(_id, f"user{i}", None, NOW - random.randint(0, 60 * 60 * 24 * 730), None) for i, _id in enumerate(ids)])
+		connection.users.update_activity([(0 if random.random() < 0.3 else int(random.paretovariate(1.2) * 50), NOW - random.randint(0, 60 * 60 * 24 * 60), _id) for _id in ids])
+		connection.execute_many("UPDATE Users SET title = ? WHERE id = ?", [(f"title{random.randint(1, 20)}", _id) for _id in random.sample(ids, users // 50)])
+		connection.badges.create_many([Types.Badge(None, f"badge {i} {random.choice(('gold', 'silver', 'event', 'mapper', 'winner'))}", f"badge{i}.png", f"Awarded for thing number {i}") for i in range(BADGES)])
+		# Some badges are far more common than others
+		weights = [1 / rank for rank in range(1, BADGES + 1)]
+		pairs = set()
+		for _id in random.sample(ids, int(users * BADGE_OWNERS)):
+			for badge in random.choices(range(1, BADGES + 1), weights, k=min(int(random.expovariate(0.5)) + 1, BADGES)):
+				pairs.add((_id, badge))
+		connection.userbadges.create_many(list(pairs))
+		connection.quests.create_many([Types.Quest(10**17 + i, f"quest {i} {random.choice(('pass', 'fc', 'ss', 'farm'))}", random.randint(1, 6), f"Complete challenge number {i}", NOW + random.randint(-60 * 60 * 24 * 30, 60 * 60 * 24 * 30)) for i in range(QUESTS)])
+		connection.execute_many("INSERT INTO UserQuests (user, easy, normal, hard, insane, extra) VALUES (?, ?, ?, ?, ?, ?)", [(_id, *[int(random.expovariate(0.7)) for tier in range(5)]) for _id in random.sample(ids, int(users * QUEST_USERS))])
+	connection.execute("ANALYZE")
+	connection.close()
+
+def benchmarks(connection: Connection, seed: int) -> dict:
+	# name -> (function taking an argument, list of arguments to cycle through)
+	random.seed(seed)
+	def sample(command: str) -> list:
+		# Sampled here rather than with ORDER BY RANDOM() so the same seed picks the same rows
+		rows = [x[0] for x in connection.execute(command, fetch=True)]
+		return random.sample(rows, min(len(rows), 1000))
+
+	ids = sample("SELECT id FROM Users ORDER BY id")
+	names = sample("SELECT name FROM Users ORDER BY id")
+	owners = sample("SELECT DISTINCT user FROM UserBadges ORDER BY user")
+	quest_users = sample("SELECT user FROM UserQuests ORDER BY user")
+	xps = [random.randint(0, 5000) for i in range(1000)]
+	pages = [random.randint(0, 50) * 10 for i in range(1000)]
+	searches = ["gold", "badge 1", "thing number 4", "event", "go"]
+	def cold(function, cache):
+		# Cached methods are also timed with their cache emptied first, as it is after a write
+		def run(argument):
+			cache.clear()
+			return function(argument)
+		return run
+
+	return {
+		"connection.execute": (lambda _id: connection.execute("SELECT * FROM Users WHERE id = ?", (_id,), fetch=1), ids),
+		"users.search[id]": (connection.users.search, ids),
+		"users.search[name]": (connection.users.search, names),
+		"users.get": (connection.users.get, ids),
+		"users.get[cold]": (cold(connection.users.get, connection.caches.users), ids),
+		"users.get_many": (lambda offset: connection.users.get_many(ids[offset % 900:offset % 900 + 100]), pages),
+		"users.update": (lambda _id: connection.users.update(_id, 'title', 'benchmarked'), ids),
+		"users.update_activity": (lambda _id: connection.users.update_activity([(1, NOW, _id)]), ids),
+		"users.xp_rank": (connection.users.xp_rank, xps),
+		"users.xp_rank[query]": (lambda xp: connection.execute("SELECT COUNT(id) FROM Users WHERE xp >= ?", (xp,), fetch=1), xps),
+		"users.xp_ranking": (lambda offset: connection.users.xp_ranking(offset=offset), pages),
+		"users.distinct_title_list": (lambda _: connection.users.distinct_title_list(), [None]),
+		"users.count": (lambda _: connection.users.count(), [None]),
+		"badges.search": (connection.badges.search, searches),
+		"badges.get": (connection.badges.get, list(range(1, BADGES + 1))),
+		"badges.image_list": (lambda _: connection.badges.image_list(), [None]),
+		"userbadges.get_image_list": (connection.userbadges.get_image_list, owners),
+		"userbadges.get_image_list[cold]": (cold(connection.userbadges.get_image_list, connection.caches.badges), owners),
+		"userbadges.user_list": (connection.userbadges.user_list, list(range(1, BADGES + 1))),
+		"userbadges.badge_counts": (lambda offset: connection.userbadges.badge_counts(offset=offset % BADGES), pages),
+		"userbadges.user_counts": (lambda offset: connection.userbadges.user_counts(offset=offset), pages),
+		"quests.search": (connection.quests.search, ["pass", "quest 1", "challenge number 2", "farm"]),
+		"quests.get_active": (lambda offset: connection.quests.get_active(offset=offset % QUESTS), pages),
+		"quests.count_active": (lambda _: connection.quests.count_active(), [None]),
+		"userquests.get": (connection.userquests.get, quest_users),
+		"userquests.get_qp": (connection.userquests.get_qp, quest_users),
+		"userquests.qp_rank": (connection.userquests.qp_rank, [xp // 100 for xp in xps]),
+		"userquests.qp_ranking": (lambda offset: connection.userquests.qp_ranking(offset=offset), pages),
+		"userquests.update_points": (lambda _id: connection.userquests.update_points(_id, 'easy', 1), quest_users),
+	}
+
+def measure(function, arguments: list, calls: int, seconds: float) -> dict:
+	# Runs until calls have been made or seconds have passed, whichever is first, after a short warm up
+	for argument in arguments[:5]:
+		function(argument)
+	times = []
+	deadline = time.perf_counter() + seconds
+	for i in range(calls):
+		argument = arguments[i % len(arguments)]
+		start = time.perf_counter_ns()
+		function(argument)
+		times.append(time.perf_counter_ns() - start)
+		if time.perf_counter() > deadline:
+			break
+	times.sort()
+	return {
+		"calls": len(times),
+		"min_us": times[0] / 1000,
+		"median_us": statistics.median(times) / 1000,
+		"p95_us": times[min(int(len(times) * 0.95), len(times) - 1)] / 1000,
+		"mean_us": statistics.fmean(times) / 1000,
+		"ops_per_sec": len(times) / (sum(times) / 1e9) if sum(times) else 0
+	}
+
+def commit() -> str:
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+	except:
+		return None
+
+def compare(path: str, results: list) -> None:
+	with open(path) as file:
+		previous = {(result["users"], result["benchmark"]): result for result in map(json.loads, file) if result}
+	print(f"{'users':>8}  {'benchmark':<34} {'before':>11} {'after':>11} {'change':>8}", file=sys.stderr)
+	for result in results:
+		before = previous.get((result["users"], result["benchmark"]))
+		if before:
+			change = (result["median_us"] - before["median_us"]) / before["median_us"] if before["median_us"] else 0
+			print(f"{result['users']:>8}  {result['benchmark']:<34} {before['median_us']:>9.1f}us {result['median_us']:>9.1f}us {change:>+8.1%}", file=sys.stderr)
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description="Benchmark the table methods of core/database.py.")
+	parser.add_argument("--users", type=int, nargs="+", default=[1000, 100000], help="database sizes to benchmark, i.e. 1000 100000 1000000")
+	parser.add_argument("--calls", type=int, default=2000, help="most calls timed per benchmark")
+	parser.add_argument("--seconds", type=float, default=2.0, help="most time spent per benchmark")
+	parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+	parser.add_argument("--directory", default="./benchmarks/data", help="where the synthetic databases are kept between runs")
+	parser.add_argument("--rebuild", action="store_true", help="build the synthetic databases again even if they exist")
+	parser.add_argument("--seed", type=int, default=2025)
+	parser.add_argument("--output", help="append results to this file instead of printing them")
+	parser.add_argument("--compare", help="earlier results file to compare medians against")
+	arguments = parser.parse_args()
+
+	os.makedirs(arguments.directory, exist_ok=True)
+	meta = {"commit": commit(), "python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "timestamp": int(time.time())}
+	results = []
+	for users in arguments.users:
+		path = os.path.join(arguments.directory, f"users-{users}-{arguments.seed}.db")
+		if arguments.rebuild or not os.path.exists(path):
+			for suffix in ("", "-wal", "-shm"):
+				if os.path.exists(path + suffix):
+					os.remove(path + suffix)
+			start = time.perf_counter()
+			print(f"Building {path}...", file=sys.stderr)
+			build(path, users, arguments.seed)
+			print(f"Built in {time.perf_counter() - start:.1f}s.", file=sys.stderr)
+		# Write benchmarks run against a copy, so every run starts from the same data
+		shutil.copy(path, f"{path}.run")
+		connection = Connection(f"{path}.run")
+		connection.start()
+		# Rankings are loaded at startup by AsyncConnection, so they are here too
+		connection.users.load_ranking()
+		for name, (function, inputs) in benchmarks(connection, arguments.seed).items():
+			if arguments.filter not in name:
+				continue
+			result = {**meta, "users": users, "benchmark": name, **measure(function, inputs, arguments.calls, arguments.seconds)}
+			results.append(result)
+			print(f"{users:>8}  {name:<34} {result['median_us']:>9.1f}us median  {result['p95_us']:>9.1f}us p95", file=sys.stderr)
+		connection.close()
+		for suffix in ("", "-wal", "-shm"):
+			if os.path.exists(f"{path}.run{suffix}"):
+				os.remove(f"{path}.run{suffix}")
+
+	lines = "".join(json.dumps(result) + "\n" for result in results)
+	if arguments.output:
+		with open(arguments.output, "a") as file:
+			file.write(lines)
+	else:
+		sys.stdout.write(lines)
+	if arguments.compare:
+		compare(arguments.compare, results)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,271 @@
+from discord.ext import commands
+from discord.http import HTTPClient
+from discord.utils import time_snowflake
+from core.database import AsyncConnection, Connection
+from core.common import Data
+from benchmarks.database import build
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+import discord
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import time
+
+# benchmarks/load.py
+# - Replays fabricated message and command traffic through the real cogs, without connecting to Discord
+# - Run from the repository root: python -m benchmarks.load [--users 10000] [--events 5000] [--mix chat=85,profile=5,...]
+# - Reports message throughput and p50/p99 latency per command and per listener, optionally as JSON
+
+MIX = {"chat": 85, "join": 2, "profile": 5, "topxp": 3, "level": 3, "beetleorb": 2}
+COMMANDS = {
+	"profile": lambda names: random.choice(("~profile", f"~profile {random.choice(names)}")),
+	"topxp": lambda names: f"~topxp {random.randint(1, 20)}",
+	"level": lambda names: "~level",
+	"beetleorb": lambda names: random.choice(("~beetleorb", "~beetleorb the")),
+}
+WORDS = "the a osu map play rank pp farm lol gg nice score pass fc accuracy star pattern stream jump slider replay".split()
+
+class StubHTTP(HTTPClient):
+	# Answers every API request locally after an optional delay, recording which routes were used
+	def __init__(self, loop=None, latency: float = 0.0) -> None:
+		super().__init__(loop)
+		self.latency = latency
+		self.routes = Counter()
+		self.replies = {}  # message id being replied to -> time the reply was sent
+		self.bot_user = None
+
+	async def static_login(self, token: str):
+		return self.bot_user
+
+	async def request(self, route, *, files=None, form=None, **kwargs):
+		self.routes[f"{route.method} {route.path}"] += 1
+		if self.latency:
+			await asyncio.sleep(self.latency)
+		if route.method == 'POST' and route.path == '/channels/{channel_id}/messages':
+			payload = kwargs.get('json')
+			if payload is None and form:
+				payload = json.loads(next(item['value'] for item in form if item['name'] == 'payload_json'))
+			reference = (payload or {}).get('message_reference')
+			if reference:
+				self.replies[int(reference['message_id'])] = time.perf_counter()
+			return message_data(route.channel_id, self.bot_user, payload.get('content') or '', guild_id=Data.SERVER_ID)
+		return None
+
+def now_iso() -> str:
+	return datetime.now(timezone.utc).isoformat()
+
+def user_data(_id: int, name: str, bot: bool = False) -> dict:
+	return {"id": str(_id), "username": name, "discriminator": "0", "global_name": None, "avatar": None, "bot": bot}
+
+def member_data() -> dict:
+	return {"roles": [], "joined_at": now_iso(), "deaf": False, "mute": False, "flags": 0}
+
+def message_data(channel_id: int, author: dict, content: str, guild_id: int = None, attachments: int = 0) -> dict:
+	data = {
+		"id": str(time_snowflake(datetime.now(timezone.utc)) + random.randint(0, 4095)), "channel_id": str(channel_id), "author": author, "content": content,
+		"timestamp": now_iso(), "edited_timestamp": None, "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [],
+		"attachments": [{"id": str(random.randint(10**17, 10**18)), "filename": "image.png", "size": 1024, "url": "https://example.com/image.png", "proxy_url": "https://example.com/image.png"} for i in range(attachments)],
+		"embeds": [], "pinned": False, "type": 0
+	}
+	if guild_id:
+		data["guild_id"] = str(guild_id)
+		data["member"] = member_data()
+	return data
+
+class Harness:
+	def __init__(self, arguments) -> None:
+		self.arguments = arguments
+		self.listeners = defaultdict(list)  # listener name -> seconds each run took
+		self.commands = defaultdict(list)  # command name -> seconds from the message arriving to the reply being sent
+		self.pending = {}  # message id -> (command name, time the message was dispatched)
+		self.tasks = set()
+		self.errors = Counter()
+
+	async def setup(self, path: str) -> None:
+		self.bot = commands.Bot(command_prefix=['~', '😠'], owner_id=1, intents=discord.Intents.all())
+		self.http = StubHTTP(latency=self.arguments.http_latency)
+		self.bot.http = self.http
+		self.bot._connection.http = self.http
+		await self.bot._async_setup_hook()
+		state = self.bot._connection
+
+		self.http.bot_user = user_data(2, "willybot", bot=True)
+		state.user = discord.ClientUser(state=state, data=self.http.bot_user)
+		self.channel_id = Data.SERVER_ID + 1
+		self.guild = discord.Guild(data={
+			"id": str(Data.SERVER_ID), "name": "load test", "owner_id": "1", "member_count": 0, "roles": [{"id": str(Data.SERVER_ID), "name": "@everyone", "permissions": "0", "position": 0, "color": 0, "hoist": False, "managed": False, "mentionable": False}],
+			"channels": [{"id": str(self.channel_id), "type": 0, "name": "general", "position": 0, "permission_overwrites": []}]
+		}, state=state)
+		state._add_guild(self.guild)
+
+		# Members are the users already in the database, as they would be on a real server
+		connection = Connection(path)
+		connection.start()
+		self.users = connection.execute("SELECT id, name FROM Users", fetch=True)
+		connection.close()
+		self.names = [name for _id, name in self.users]
+		for _id, name in self.users:
+			self.add_member(_id, name)
+		self.next_user = max(_id for _id, name in self.users) + 1
+
+		# Shared objects are attached to the bot before the cogs load, so they use this database
+		self.bot.database = AsyncConnection(path)
+		for cog in self.arguments.cogs:
+			await self.bot.load_extension(f"cogs.{cog}")
+		if not self.arguments.cooldowns:
+			for command in self.bot.walk_commands():
+				command._buckets = commands.CooldownMapping(None, commands.BucketType.default)
+
+		harness = self
+		original = self.bot._run_event
+		async def run_event(coro, event_name, *args, **kwargs):
+			start = time.perf_counter()
+			try:
+				await original(coro, event_name, *args, **kwargs)
+			finally:
+				harness.listeners[coro.__qualname__].append(time.perf_counter() - start)
+		self.bot._run_event = run_event
+		original_schedule = self.bot._schedule_event
+		def schedule_event(*args, **kwargs):
+			task = original_schedule(*args, **kwargs)
+			harness.tasks.add(task)
+			task.add_done_callback(harness.tasks.discard)
+			return task
+		self.bot._schedule_event = schedule_event
+		@self.bot.event
+		async def on_command_error(context, error):
+			harness.errors[f"{context.command.name if context.command else '?'}: {type(error).__name__}"] += 1
+
+	def add_member(self, _id: int, name: str) -> discord.Member:
+		member = discord.Member(data={"user": user_data(_id, name), **member_data()}, guild=self.guild, state=self.bot._connection)
+		self.guild._add_member(member)
+		return member
+
+	def event(self, kind: str) -> dict:
+		if kind == "join":
+			# A member who isn't in the database yet, so their first message registers them
+			_id, name = self.next_user, f"newuser{self.next_user}"
+			self.next_user += 1
+			self.add_member(_id, name)
+			self.names.append(name)
+			return message_data(self.channel_id, user_data(_id, name), "hello", guild_id=Data.SERVER_ID)
+		_id, name = random.choice(self.users)
+		if kind == "chat":
+			content = " ".join(random.choices(WORDS, k=random.randint(1, 25)))
+			return message_data(self.channel_id, user_data(_id, name), content, guild_id=Data.SERVER_ID, attachments=int(random.random() < 0.05))
+		return message_data(self.channel_id, user_data(_id, name), COMMANDS[kind](self.names), guild_id=Data.SERVER_ID)
+
+	def dispatch(self, kind: str) -> None:
+		message = discord.Message(state=self.bot._connection, channel=self.guild.get_channel(self.channel_id), data=self.event(kind))
+		if kind in COMMANDS:
+			self.pending[message.id] = (kind, time.perf_counter())
+		self.bot.dispatch('message', message)
+
+	async def run(self) -> dict:
+		kinds, weights = zip(*self.arguments.mix.items())
+		traffic = random.choices(kinds, weights, k=self.arguments.events)
+		start = time.perf_counter()
+		# Traffic arrives in bursts, spaced out to keep to the given rate (if any)
+		for i in range(0, len(traffic), self.arguments.burst):
+			for kind in traffic[i:i + self.arguments.burst]:
+				self.dispatch(kind)
+			if self.arguments.rate:
+				await asyncio.sleep(self.arguments.burst / self.arguments.rate)
+			else:
+				await asyncio.sleep(0)
+		while self.tasks:
+			await asyncio.gather(*list(self.tasks), return_exceptions=True)
+		elapsed = time.perf_counter() - start
+
+		for message_id, (kind, dispatched) in self.pending.items():
+			if message_id in self.http.replies:
+				self.commands[kind].append(self.http.replies[message_id] - dispatched)
+		counts = Counter(traffic)
+		return {
+			"events": len(traffic), "seconds": elapsed, "events_per_sec": len(traffic) / elapsed,
+			"messages_per_sec": (counts["chat"] + counts["join"]) / elapsed, "counts": dict(counts),
+			"commands": {name: summary(times) | {"unanswered": counts[name] - len(times)} for name, times in self.commands.items()},
+			"listeners": {name: summary(times) for name, times in self.listeners.items()},
+			"http": dict(self.http.routes), "errors": dict(self.errors)
+		}
+
+	async def close(self) -> None:
+		if not hasattr(self, 'bot'):
+			return
+		for cog in list(self.bot.extensions):
+			await self.bot.unload_extension(cog)
+		if hasattr(self.bot, 'database'):
+			self.bot.database.close()
+
+def summary(times: list) -> dict:
+	times = sorted(times)
+	if not times:
+		return {"count": 0}
+	return {"count": len(times), "p50_ms": statistics.median(times) * 1000, "p99_ms": times[min(int(len(times) * 0.99), len(times) - 1)] * 1000, "max_ms": times[-1] * 1000}
+
+def parse_mix(text: str) -> dict:
+	mix = {}
+	for part in text.split(','):
+		kind, weight = part.split('=')
+		if kind not in MIX:
+			raise argparse.ArgumentTypeError(f"Unknown traffic kind '{kind}', use any of {', '.join(MIX)}")
+		mix[kind] = float(weight)
+	return mix
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description="Replay message and command traffic through the cogs without connecting to Discord.")
+	parser.add_argument("--users", type=int, default=10000, help="users in the synthetic database (and members of the fake server)")
+	parser.add_argument("--events", type=int, default=5000, help="messages and commands to replay")
+	parser.add_argument("--mix", type=parse_mix, default=MIX, help="weights of each kind of traffic, i.e. " + ",".join(f"{kind}={weight}" for kind, weight in MIX.items()))
+	parser.add_argument("--burst", type=int, default=50, help="events dispatched back to back")
+	parser.add_argument("--rate", type=float, default=0, help="events per second to keep to, 0 for as fast as possible")
+	parser.add_argument("--http-latency", type=float, default=0.0, help="seconds each stubbed API request takes")
+	parser.add_argument("--cogs", nargs="+", default=["users", "fun"], help="cogs to load")
+	parser.add_argument("--cooldowns", action="store_true", help="keep command cooldowns, which otherwise reject most repeated commands")
+	parser.add_argument("--directory", default="./benchmarks/data", help="where the synthetic databases are kept between runs")
+	parser.add_argument("--seed", type=int, default=2025)
+	parser.add_argument("--output", help="write the full results as JSON to this file")
+	arguments = parser.parse_args()
+
+	random.seed(arguments.seed)
+	os.makedirs(arguments.directory, exist_ok=True)
+	path = os.path.join(arguments.directory, f"users-{arguments.users}-{arguments.seed}.db")
+	if not os.path.exists(path):
+		print(f"Building {path}...", file=sys.stderr)
+		build(path, arguments.users, arguments.seed)
+	# Replayed traffic writes to the database, so it runs against a copy
+	shutil.copy(path, f"{path}.load")
+
+	async def replay() -> dict:
+		harness = Harness(arguments)
+		try:
+			await harness.setup(f"{path}.load")
+			return await harness.run()
+		finally:
+			await harness.close()
+	try:
+		results = asyncio.run(replay())
+	finally:
+		for suffix in ("", "-wal", "-shm"):
+			if os.path.exists(f"{path}.load{suffix}"):
+				os.remove(f"{path}.load{suffix}")
+
+	print(f"{results['events']} events in {results['seconds']:.2f}s: {results['events_per_sec']:.0f} events/s, {results['messages_per_sec']:.0f} messages/s", file=sys.stderr)
+	for section in ("commands", "listeners"):
+		for name, result in sorted(results[section].items()):
+			if result["count"]:
+				print(f"  {name:<28} {result['count']:>6}  p50 {result['p50_ms']:>8.2f}ms  p99 {result['p99_ms']:>8.2f}ms", file=sys.stderr)
+	if results["errors"]:
+		print(f"  errors: {results['errors']}", file=sys.stderr)
+	if arguments.output:
+		with open(arguments.output, "w") as file:
+			json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+	main()
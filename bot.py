@@ -1,5 +1,8 @@
 ﻿import discord
 from discord.ext import commands
+from core.profiler import Profiler
+from io import BytesIO
+import asyncio
 import os
 from dotenv import load_dotenv
 
@@ -47,6 +50,18 @@ async def reload(context, extension: str) -> None:
 	await bot.load_extension(f'cogs.{extension}')
 	await context.send(f'Reloaded cog: `{extension}`')
 
+@bot.command(description="Profile every thread of the bot for a number of seconds.")
+@commands.is_owner()
+async def profiler(context, seconds: float = 10) -> None:
+	# Sampling runs on its own thread, so nothing is slowed down while no profile is being taken
+	seconds = min(max(seconds, 1), Profiler.MAX_SECONDS)
+	if Profiler.running.locked():
+		await context.send('`Already profiling.`')
+		return
+	await context.send(f'Profiling for `{seconds:g}s`...')
+	report = await asyncio.to_thread(Profiler().run, seconds)
+	await context.send(file=discord.File(BytesIO(report.encode()), filename='profile.txt'))
+
 @bot.command(description="Reload a cog into the bot.")
 @commands.is_owner()
 async def reloadall(context) -> None:
@@ -57,4 +72,10 @@ async def reloadall(context) -> None:
 		pass
 	await context.send(f'`Reloaded all cogs.`')
 
-bot.run(os.environ.get("BOT_TOKEN"), root_logger=True)
\ No newline at end of file
+# Processes spawned to render profiles import this file too, and must not start another bot
+if __name__ == "__main__":
+	bot.run(os.environ.get("BOT_TOKEN"), root_logger=True)
+
+	# The database is shared by every cog (see AsyncConnection.shared), so it is only closed once the bot has stopped
+	if hasattr(bot, 'database'):
+		bot.database.close()
\ No newline at end of file
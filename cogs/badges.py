@@ -1,7 +1,9 @@
 from discord.ext import commands
 from discord import File
-from core.database import Connection, Types
+from core.database import AsyncConnection, Types
 from core.common import Data, Embeds
+from core.images import BadgeImages
+import asyncio
 
 # cogs/badges.py
 # - (Badges) commands.Cog for user badge related commands/listeners
@@ -9,16 +11,19 @@ from core.common import Data, Embeds
 class Badges(commands.Cog):
 	def __init__(self, bot) -> None:
 		self.bot = bot
-		self.database = Connection()
-		self.database.start()
+		self.database = AsyncConnection.shared(bot)
+		self.badge_images = BadgeImages.shared(bot)
+
+	async def cog_load(self) -> None:
+		await self.database.start()
 	
 	@commands.command(aliases=['b'],  description="List of all users with a specified badge.")
 	@commands.cooldown(1, 3, commands.BucketType.user)
 	async def badge(self, context, *, identifier) -> None:
 		try:
-			badge_id = self.database.badges.search(identifier)
-			badge = self.database.badges.get(badge_id)
-			user_list = self.database.userbadges.user_list(badge.id)
+			badge_id = await self.database.badges.search(identifier)
+			badge = await self.database.badges.get(badge_id)
+			user_list = await self.database.userbadges.user_list(badge.id)
 			user_list = ', '.join([x[0] for x in user_list])
 			file = File(Data.BADGE_PATH + badge.image, filename="badge.png")
 			await context.reply(embed=Embeds.simple_embed(badge.name, f'*{badge.description}*', fields=[("Owned by", user_list)], image="attachment://badge.png" ), file=file, mention_author=False)
@@ -29,32 +34,32 @@ class Badges(commands.Cog):
 	@commands.is_owner()
 	async def addbadge(self, context, username, *, identifier) -> None:
 		try:
-			user_id = self.database.users.search(username)
+			user_id = await self.database.users.search(username)
 		except:
 			await context.reply(f"Could not find user.", mention_author=False)
 			return
 		try:
-			badge_id = self.database.badges.search(identifier)
+			badge_id = await self.database.badges.search(identifier)
 		except:
 			await context.reply(f"Could not find badge.", mention_author=False)
 		
-		self.database.userbadges.create(user_id, badge_id)
+		await self.database.userbadges.create(user_id, badge_id)
 		await context.reply(f"Added badge id \'{badge_id}\' to user!", mention_author=False)
 
 	@commands.command(aliases=['rb'], description="Remove badge from a specified user.")
 	@commands.is_owner()
 	async def removebadge(self, context, username, *, identifier) -> None:
 		try:
-			user_id = self.database.users.search(username)
+			user_id = await self.database.users.search(username)
 		except:
 			await context.reply(f"Could not find user.", mention_author=False)
 			return
 		try:
-			badge_id = self.database.badges.search(identifier)
+			badge_id = await self.database.badges.search(identifier)
 		except:
 			await context.reply(f"Could not find badge.", mention_author=False)
 
-		self.database.userbadges.delete(user_id, badge_id)
+		await self.database.userbadges.delete(user_id, badge_id)
 		await context.reply(f"Removed badge id \'{badge_id}\' from user!", mention_author=False)
 	
 	@commands.command(aliases=['cb'],  description="Create name and image for a badge. [NAME::IMAGE]")
@@ -62,9 +67,16 @@ class Badges(commands.Cog):
 	async def createbadge(self, context, *, badge_info: str) -> None:
 		badge = Types.Badge(None, *[x.strip() for x in badge_info.split("::")]) 
 		try:
-			self.database.badges.create(badge)
-			badge = self.database.badges.search(badge.name)
-			badge = self.database.badges.get(badge)
+			# Decoded off the event loop, and kept for rendering profiles once the badge is created
+			image = await asyncio.to_thread(self.badge_images.decode, badge.image)
+		except:
+			await context.reply(f"Could not open badge image '{badge.image}'.", mention_author=False)
+			return
+		try:
+			await self.database.badges.create(badge)
+			self.badge_images.put(badge.image, image)
+			badge = await self.database.badges.search(badge.name)
+			badge = await self.database.badges.get(badge)
 			await context.reply(f"Created badge \'{badge.name}\' with image \'{badge.image}\'. `ID: {badge.id}`", mention_author=False)
 		except:
 			await context.reply(f"Could not create badge.", mention_author=False)
@@ -73,9 +85,10 @@ class Badges(commands.Cog):
 	@commands.is_owner()
 	async def deletebadge(self, context, *, identifier) -> None:
 		try:
-			badge_id = self.database.badges.search(identifier)
-			badge = self.database.badges.get(badge_id)
-			self.database.badges.delete(badge.id)
+			badge_id = await self.database.badges.search(identifier)
+			badge = await self.database.badges.get(badge_id)
+			await self.database.badges.delete(badge.id)
+			self.badge_images.remove(badge.image)
 			await context.reply(f"Deleted badge \'{badge.name}\' with image \'{badge.image}\'. `ID: {badge.id}`.", mention_author=False)
 		except:
 			await context.reply(f"Could not find badge.", mention_author=False)
@@ -85,9 +98,20 @@ class Badges(commands.Cog):
 	async def updatebadge(self, context, *, badge_info: str) -> None:
 		identifier, attribute, value = [x.strip() for x in badge_info.split("::")]
 		attribute = attribute.lower()
+		if attribute == 'image':
+			try:
+				image = await asyncio.to_thread(self.badge_images.decode, value)
+			except:
+				await context.reply(f"Could not open badge image '{value}'.", mention_author=False)
+				return
 		try:
-			badge_id = self.database.badges.search(identifier)
-			self.database.badges.update(badge_id, attribute, value)
+			badge_id = await self.database.badges.search(identifier)
+			badge = await self.database.badges.get(badge_id)
+			await self.database.badges.update(badge_id, attribute, value)
+			if attribute == 'image':
+				self.badge_images.put(value, image)
+				if badge.image != value:
+					self.badge_images.remove(badge.image)
 			await context.reply(f"Changed \"{attribute}\" of `ID:{badge_id}` to `{value}`.", mention_author=False)
 		except:
 			await context.reply(f"Could not update badge.", mention_author=False)
@@ -95,24 +119,22 @@ class Badges(commands.Cog):
 	@commands.command(aliases=['bl', 'badges', 'badgelist'],  description="List all awarded badges.")
 	@commands.cooldown(1, 3, commands.BucketType.user)
 	async def listbadges(self, context, page: int = 1) -> None:
-		offset, page_text = Data.paginate(page, length=self.database.userbadges.count_badges())
-		badge_counts = self.database.userbadges.badge_counts(offset=offset)
+		offset, page_text = Data.paginate(page, length=await self.database.userbadges.count_badges())
+		badge_counts = await self.database.userbadges.badge_counts(offset=offset)
 		badge_string = []
-		for badge_id, count in badge_counts:
-			badge = self.database.badges.get(badge_id)
-			badge_string.append(f"- {badge.name} **({count:,})** \n-# *{Data.cutoff_text(badge.description, 52)}*")
+		for badge_id, name, description, count in badge_counts:
+			badge_string.append(f"- {name} **({count:,})** \n-# *{Data.cutoff_text(description, 52)}*")
 		await context.reply(embed=Embeds.simple_embed(None, None, fields=[("List of all awarded badges", '\n'.join(badge_string))], footer=page_text), mention_author=False)
 	
 	@commands.command(aliases=['tb'],  description="List all awarded badges.")
 	@commands.cooldown(1, 3, commands.BucketType.user)
 	async def topbadges(self, context, page: int = 1) -> None:
-		offset, page_text = Data.paginate(page, length=self.database.userbadges.count_users())
-		user_counts = self.database.userbadges.user_counts(offset=offset)
+		offset, page_text = Data.paginate(page, length=await self.database.userbadges.count_users())
+		user_counts = await self.database.userbadges.user_counts(offset=offset)
 		user_string = []
-		for user, count in user_counts:
+		for user_id, name, count in user_counts:
 			offset += 1
-			user = self.database.users.get(user)
-			user_string.append(f"`#{offset}`  **{user.name}**  ({count:,})")
+			user_string.append(f"`#{offset}`  **{name}**  ({count:,})")
 		await context.reply(embed=Embeds.simple_embed(None, None, fields=[("List of most decorated users", '\n'.join(user_string))], footer=page_text), mention_author=False)
 			
 
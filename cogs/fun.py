@@ -1,22 +1,112 @@
 from discord.ext import commands
 from discord import AllowedMentions
+import asyncio
 import random
 import re
 import os
 
 # cogs/fun.py
+# - (Quotes) chat log quotes with a trigram index for searching
 # - (Fun) commands.Cog for fun commands/listeners
 
+class Quotes:
+	PATTERN = re.compile(r'\[[0-9]{4}\-[0-9]{1,2}\-[0-9]{1,2}\ [0-9]{1,2}\:[0-9]{2}\:[0-9]{2}\]\ \#[a-z\d]*_?[a-z\d]+\ (.*)')
+
+	def __init__(self, filename: str) -> None:
+		self.filename = filename
+		# Updates run on a worker thread, so searches wait for them rather than seeing half an update
+		self.lock = asyncio.Lock()
+		self.reset()
+		self.update()
+
+	def reset(self) -> None:
+		self.quotes = []
+		self.lowered = []
+		self.index = {}  # trigram -> indexes of quotes containing it, in ascending order
+		self.offset = 0  # How many bytes of the file have been read, up to the end of the last whole line
+		self.tail = b''  # Bytes after that, a last line that may still be being written
+		self.tentative = False  # Whether the last quote was parsed from the tail, and has to be parsed again once it's whole
+
+	def shared(bot, filename: str) -> 'Quotes':
+		# Kept on the bot so reloading the cog doesn't parse the whole file again
+		if not hasattr(bot, 'quotes') or bot.quotes.filename != filename:
+			bot.quotes = Quotes(filename)
+		return bot.quotes
+
+	def trigrams(text: str) -> set:
+		return {text[i:i + 3] for i in range(len(text) - 2)}
+
+	def update(self) -> int:
+		# Only lines appended to the file since the last update are parsed
+		size = os.path.getsize(self.filename)
+		if size < self.offset + len(self.tail):
+			# The file was truncated or replaced, so whatever was read from it before can't be trusted
+			self.reset()
+		elif size == self.offset + len(self.tail):
+			return 0
+		with open(self.filename, mode='rb') as file:
+			file.seek(self.offset)
+			data = file.read()
+		# A byte order mark can only be at the very start of the file
+		encoding = 'utf-8-sig' if self.offset == 0 else 'utf-8'
+		end = data.rfind(b'\n') + 1
+		if self.tentative:
+			self.remove_last()
+		added = self.parse(data[:end].decode(encoding))
+		self.offset += end
+		# The file doesn't have to end with a line break, so an unfinished last line is still searchable until it's finished
+		self.tail = data[end:]
+		try:
+			tail = self.parse(self.tail.decode(encoding if end == 0 else 'utf-8'))
+		except UnicodeDecodeError:
+			# Cut off in the middle of a character
+			tail = 0
+		self.tentative = tail > 0
+		return added + tail
+
+	def parse(self, text: str) -> int:
+		added = 0
+		for line in text.splitlines():
+			match = Quotes.PATTERN.match(line)
+			if match:
+				self.add(match.group(1))
+				added += 1
+		return added
+
+	def add(self, quote: str) -> None:
+		position = len(self.quotes)
+		self.quotes.append(quote)
+		self.lowered.append(quote.lower())
+		for trigram in Quotes.trigrams(self.lowered[position]):
+			self.index.setdefault(trigram, []).append(position)
+
+	def remove_last(self) -> None:
+		# The last quote is at the end of every posting it's in
+		for trigram in Quotes.trigrams(self.lowered.pop()):
+			self.index[trigram].pop()
+			if not self.index[trigram]:
+				del self.index[trigram]
+		self.quotes.pop()
+
+	def search(self, text: str) -> list:
+		# Quotes containing every word of text (case insensitive)
+		words = text.lower().split()
+		candidates = None
+		# Intersect starting from the rarest trigram so the candidate set stays small
+		postings = sorted((self.index.get(trigram, []) for word in words for trigram in Quotes.trigrams(word)), key=len)
+		for posting in postings:
+			candidates = set(posting) if candidates is None else candidates.intersection(posting)
+			if not candidates:
+				return []
+		# Words shorter than 3 letters have no trigrams, and trigrams alone don't guarantee a match, so check them
+		candidates = range(len(self.quotes)) if candidates is None else sorted(candidates)
+		return [self.quotes[i] for i in candidates if all(word in self.lowered[i] for word in words)]
+
 class Fun(commands.Cog):
 	def __init__(self, bot) -> None:
 		self.bot = bot
 		self.mystery_path = "./misc/mystery.txt"
-		self.quotes = self.load_beetleorb("./misc/beetleorb.txt", r'\[[0-9]{4}\-[0-9]{1,2}\-[0-9]{1,2}\ [0-9]{1,2}\:[0-9]{2}\:[0-9]{2}\]\ \#[a-z\d]*_?[a-z\d]+\ (.*)')
-		
-	def load_beetleorb(self, filename, regex: str) -> list:
-		with open(filename, encoding='utf-8') as file:
-			matches = re.findall(regex, file.read())
-		return(matches)
+		self.quotes = Quotes.shared(bot, "./misc/beetleorb.txt")
 	
 	@commands.Cog.listener()
 	async def on_message(self, context) -> None:
@@ -37,11 +127,15 @@ class Fun(commands.Cog):
 	@commands.command(aliases=['bo', 'beetle', 'quote'],  description="Get a random beetleorb quote.")
 	@commands.cooldown(1, 3, commands.BucketType.user)
 	async def beetleorb(self, context, *, search: str = None) -> None:
+		async with self.quotes.lock:
+			# Reading the file blocks, so it's kept off the event loop
+			await asyncio.to_thread(self.quotes.update)
+			results = self.quotes.search(search) if search else self.quotes.quotes
 		if not search:
-			await context.reply(">>> " + random.choice(self.quotes), mention_author=False)
+			await context.reply(">>> " + random.choice(results), mention_author=False)
 		else:
 			try:
-				result = random.choice([quote for quote in self.quotes if search.lower() in quote.lower()])
+				result = random.choice(results)
 				await context.reply(">>> " + result, mention_author=False)
 			except:
 				await context.reply("Could not find quote.", mention_author=False)
@@ -0,0 +1,135 @@
+from discord.ext import commands, tasks
+from discord import File
+from core.database import AsyncConnection
+from core.common import Time
+from core.metrics import Metrics
+from core.resolver import Resolver
+from core.watchdog import LoopWatchdog
+from io import BytesIO
+import asyncio
+import os
+import time
+
+# cogs/metrics.py
+# - (Monitoring) commands.Cog recording command, listener and query latency, cache hit rates, event loop lag and stalls
+
+class Monitoring(commands.Cog):
+	LAG_INTERVAL = 0.5  # Seconds between event loop lag measurements
+	PATH = "./metrics.prom"  # Where metrics are dumped, appended as JSON lines instead if the path ends with .jsonl
+
+	def __init__(self, bot) -> None:
+		self.bot = bot
+		self.metrics = Metrics.shared(bot)
+		self.database = AsyncConnection.shared(bot)
+		self.resolver = Resolver.shared(bot)
+		self.watchdog = LoopWatchdog.shared(bot)
+		self.path = os.environ.get("METRICS_PATH", Monitoring.PATH)
+		self.lag_task = None
+
+	async def cog_load(self) -> None:
+		await self.database.start()
+		self.database.instrument(self.metrics)
+		self.bot.before_invoke(self.before_invoke)
+		self.bot.after_invoke(self.after_invoke)
+		# Every listener (including the one running commands) is run by Client._run_event, so it's wrapped to time them all
+		self.bot._run_event = self.run_event
+		caches = self.database.caches
+		self.metrics.gauge("cache_hit_ratio", lambda: [({"cache": name}, cache.stats()["hit_rate"]) for name, cache in (("users", caches.users), ("badges", caches.badges), ("profiles", caches.profiles))])
+		self.metrics.gauge("cache_entries", lambda: [({"cache": name}, cache.stats()["size"]) for name, cache in (("users", caches.users), ("badges", caches.badges), ("profiles", caches.profiles))])
+		self.metrics.gauge("resolver_hit_ratio", lambda: [({"kind": kind}, stats["hit_rate"]) for kind, stats in self.resolver.stats().items()])
+		self.lag_task = asyncio.create_task(self.measure_lag())
+		self.watchdog.start()
+		self.dump_metrics.start()
+
+	async def cog_unload(self) -> None:
+		self.dump_metrics.cancel()
+		if self.lag_task:
+			self.lag_task.cancel()
+		self.watchdog.stop()
+		del self.bot._run_event
+		self.bot._before_invoke = None
+		self.bot._after_invoke = None
+		self.database.instrument(None)
+
+	async def before_invoke(self, context) -> None:
+		context.invoke_started = time.perf_counter()
+
+	async def after_invoke(self, context) -> None:
+		# Also called when the command raised, so failures are timed too
+		if hasattr(context, 'invoke_started'):
+			self.metrics.observe("command_seconds", time.perf_counter() - context.invoke_started, command=context.command.qualified_name, failed=context.command_failed)
+
+	async def run_event(self, coro, event_name: str, *args, **kwargs) -> None:
+		start = time.perf_counter()
+		try:
+			await type(self.bot)._run_event(self.bot, coro, event_name, *args, **kwargs)
+		finally:
+			self.metrics.observe("listener_seconds", time.perf_counter() - start, event=event_name, listener=coro.__qualname__)
+
+	async def measure_lag(self) -> None:
+		# How much later than asked a sleep wakes up is how long the event loop was kept busy by something else
+		loop = asyncio.get_running_loop()
+		while True:
+			start = loop.time()
+			await asyncio.sleep(Monitoring.LAG_INTERVAL)
+			self.metrics.observe("event_loop_lag_seconds", max(loop.time() - start - Monitoring.LAG_INTERVAL, 0))
+
+	@tasks.loop(minutes=1)
+	async def dump_metrics(self) -> None:
+		if self.path.endswith(".jsonl"):
+			text, mode = self.metrics.json(Time.current_timestamp()) + "\n", 'a'
+		else:
+			text, mode = self.metrics.prometheus(), 'w'
+		await asyncio.to_thread(Monitoring.write, self.path, text, mode)
+
+	def write(path: str, text: str, mode: str) -> None:
+		if mode == 'a':
+			with open(path, mode='a', encoding='utf-8') as file:
+				file.write(text)
+		else:
+			# Replaced whole so whatever scrapes the file never reads half of it
+			with open(f"{path}.tmp", mode='w', encoding='utf-8') as file:
+				file.write(text)
+			os.replace(f"{path}.tmp", path)
+
+	@commands.command(aliases=['metrics', 'perf'], description="Show command, listener and query latencies. [NAME]")
+	@commands.is_owner()
+	async def latency(self, context, name: str = None) -> None:
+		snapshot = self.metrics.snapshot()
+		# Slowest in total first, as that's where time is going
+		histograms = sorted(((key, histogram) for key, histogram in snapshot["histograms"].items() if not name or name in key[0]), key=lambda item: item[1]["sum"], reverse=True)
+		lines = [f"{'metric':<60} {'count':>8} {'p50':>9} {'p99':>9} {'max':>9}"]
+		for (metric, labels), histogram in histograms:
+			label = metric + (f"[{','.join(f'{label}={value}' for label, value in labels)}]" if labels else "")
+			lines.append(f"{label[:60]:<60} {histogram['count']:>8} {histogram['p50'] * 1000:>7.1f}ms {histogram['p99'] * 1000:>7.1f}ms {histogram['max'] * 1000:>7.1f}ms")
+		for metric, values in snapshot["gauges"].items():
+			if not name or name in metric:
+				for labels, value in values:
+					lines.append(f"{metric}[{','.join(f'{label}={x}' for label, x in labels.items())}] {value:.3f}")
+		text = "\n".join(lines)
+		if len(text) < 1900:
+			await context.reply(f"```\n{text}\n```", mention_author=False)
+		else:
+			await context.reply(file=File(BytesIO(text.encode()), filename="metrics.txt"), mention_author=False)
+
+	@commands.command(aliases=['blocking'], description="Show where the event loop has been blocked, or clear the list. [reset]")
+	@commands.is_owner()
+	async def stalls(self, context, action: str = None) -> None:
+		if action == "reset":
+			self.watchdog.clear()
+			await context.reply("Cleared recorded stalls.", mention_author=False)
+			return
+		sites = self.watchdog.report()
+		if not sites:
+			await context.reply(f"The event loop hasn't been blocked for over {self.watchdog.threshold * 1000:.0f}ms.", mention_author=False)
+			return
+		lines = [f"{'site':<60} {'count':>6} {'total':>9} {'max':>9}"]
+		for site, entry in sites:
+			lines.append(f"{site[:60]:<60} {entry['count']:>6} {entry['total']:>8.2f}s {entry['max'] * 1000:>7.0f}ms")
+		summary = "\n".join(lines)
+		# Stacks are only sent in the attachment, they'd never fit in a message
+		stacks = "\n\n".join(f"{site}  (last at {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(entry['last']))} UTC)\n{entry['stack']}" for site, entry in sites)
+		await context.reply(f"```\n{summary[:1900]}\n```", file=File(BytesIO(f"{summary}\n\n{stacks}".encode()), filename="stalls.txt"), mention_author=False)
+
+async def setup(bot):
+	await bot.add_cog(Monitoring(bot))
@@ -1,6 +1,8 @@
 from discord.ext import commands
-from core.database import Connection, Types
+from core.database import AsyncConnection, Types
 from core.common import Data, Time, Embeds, Quest
+from core.resolver import Resolver
+from core.scheduler import ExpiryScheduler
 
 # cogs/quests.py
 # - (Quests) commands.Cog for quest related commands/listeners
@@ -8,14 +10,18 @@ from core.common import Data, Time, Embeds, Quest
 class Quests(commands.Cog):
 	def __init__(self, bot):
 		self.bot = bot
-		self.database = Connection()
-		self.database.start()
+		self.database = AsyncConnection.shared(bot)
+		self.resolver = Resolver.shared(bot)
+		self.expiry = ExpiryScheduler.shared(bot, 'quests')
+
+	async def cog_load(self) -> None:
+		await self.database.start()
 	
 	@commands.command(aliases=['lq', 'ql'],  description="List of currently active quests.")
 	@commands.cooldown(1, 3, commands.BucketType.user)
 	async def listquests(self, context, page: int = 1) -> None:
-		offset, page_text = Data.paginate(page, length=self.database.quests.count_active())
-		quests = self.database.quests.get_active(offset=offset)
+		offset, page_text = Data.paginate(page, length=await self.database.quests.count_active())
+		quests = await self.database.quests.get_active(offset=offset)
 		quest_string = []
 		for quest in quests:
 			tier_name, tier_icon = Quest.TIERS[quest.tier]
@@ -27,8 +33,8 @@ class Quests(commands.Cog):
 	@commands.cooldown(1, 3, commands.BucketType.user)
 	async def searchquest(self, context, *, identifier) -> None:
 		try:
-			quest_id = self.database.quests.search(identifier)
-			quest = self.database.quests.get(quest_id)
+			quest_id = await self.database.quests.search(identifier)
+			quest = await self.database.quests.get(quest_id)
 			tier_name, tier_icon = Quest.TIERS[quest.tier]
 			difficulty_field = ("Difficulty", f"{tier_icon} {tier_name} ({quest.tier} QP)")
 			expires_field = ("Expires", f"<t:{quest.expires}:R>")
@@ -72,13 +78,14 @@ class Quests(commands.Cog):
 		difficulty_field = ("Difficulty", f"{tier_icon} {tier_name} ({tier} QP)")
 		expires_field = ("Expires", f"<t:{expires}:R>")
 
-		channel = await self.bot.fetch_channel(Quest.CHANNEL)
+		channel = await self.resolver.channel(Quest.CHANNEL)
 		message = await channel.send(embed=Embeds.simple_embed(name, description, fields=[difficulty_field, expires_field]))
 		
 		quest = Types.Quest(message.id, name, tier, description, expires)
 		try:
-			self.database.quests.create(quest)
-			quest = self.database.quests.get(quest.id)
+			await self.database.quests.create(quest)
+			quest = await self.database.quests.get(quest.id)
+			self.expiry.schedule(quest.id, quest.expires + Quest.EXPIRED_FOR)
 			await context.reply(f"Created quest \'{quest.name}\'. `ID: {quest.id}`", mention_author=False)
 		except:
 			await context.reply(f"Could not create quest.", mention_author=False)
@@ -89,15 +96,17 @@ class Quests(commands.Cog):
 		identifier, attribute, value = [x.strip() for x in quest_info.split("::")]
 		attribute = attribute.lower()
 		try:
-			quest_id = self.database.quests.search(identifier)
-			self.database.quests.update(quest_id, attribute, value)
-			quest = self.database.quests.get(quest_id)
+			quest_id = await self.database.quests.search(identifier)
+			await self.database.quests.update(quest_id, attribute, value)
+			quest = await self.database.quests.get(quest_id)
+			if isinstance(quest.expires, int):
+				self.expiry.schedule(quest.id, quest.expires + Quest.EXPIRED_FOR)
 			
 			tier_name, tier_icon = Quest.TIERS[quest.tier]
 			difficulty_field = ("Difficulty", f"{tier_icon} {tier_name} ({quest.tier} QP)")
 			expires_field = ("Expires", f"<t:{quest.expires}:R>")
 			
-			channel = await self.bot.fetch_channel(Quest.CHANNEL)
+			channel = await self.resolver.channel(Quest.CHANNEL)
 			message = await channel.fetch_message(quest.id)
 			await message.edit(embed=Embeds.simple_embed(quest.name, quest.description, fields=[difficulty_field, expires_field]))
 			
@@ -109,10 +118,11 @@ class Quests(commands.Cog):
 	@commands.is_owner()
 	async def deletequest(self, context, *, identifier: str) -> None:
 		try:
-			quest_id = self.database.quests.search(identifier)
-			quest = self.database.quests.get(quest_id)
-			self.database.quests.delete(quest_id)
-			channel = await self.bot.fetch_channel(Quest.CHANNEL)
+			quest_id = await self.database.quests.search(identifier)
+			quest = await self.database.quests.get(quest_id)
+			await self.database.quests.delete(quest_id)
+			self.expiry.cancel(quest_id)
+			channel = await self.resolver.channel(Quest.CHANNEL)
 			message = await channel.fetch_message(quest_id)
 			await message.delete()
 
@@ -125,17 +135,17 @@ class Quests(commands.Cog):
 	async def queststats(self, context, identifier=None) -> None:
 		identifier = context.author.id if not identifier else Data.convert_mention(identifier)
 		try:
-			user_id = self.database.users.search(identifier)
-			user = self.database.users.get(user_id)
+			user_id = await self.database.users.search(identifier)
+			user = await self.database.users.get(user_id)
 			try:
-				user_quests = self.database.userquests.get(user.id)
+				user_quests = await self.database.userquests.get(user.id)
 				user_quests_string = []
 				total_qp = 0
 				for i in range(1, len(user_quests)):
 					tier_name, tier_icon = Quest.TIERS[i]
 					total_qp += user_quests[i] * (i)
 					user_quests_string.append(f"**{tier_icon} {tier_name}**  -  **{user_quests[i]}** ({user_quests[i] * (i)} QP)")
-				qp_rank = self.database.userquests.qp_rank(total_qp)
+				qp_rank = await self.database.userquests.qp_rank(total_qp)
 				await context.reply(embed=Embeds.simple_embed(f"{user.name}", None, fields=[("Quest points", f"{total_qp} QP  **`#{qp_rank}`**"), (f"**{sum(user_quests[1:])} quests completed**", '\n'.join(user_quests_string))]), mention_author=False)
 			except:
 				await context.reply(f"User has not completed any quests.", mention_author=False)
@@ -145,32 +155,26 @@ class Quests(commands.Cog):
 	@commands.command(aliases=['qlb', 'tq'],  description="List of highest QP users.")
 	@commands.cooldown(1, 3, commands.BucketType.user)
 	async def topqp(self, context, page: int = 1) -> None:
-		offset, page_text = Data.paginate(page, length=self.database.userquests.count())
-		user_qps = self.database.userquests.qp_ranking(offset=offset)
+		offset, page_text = Data.paginate(page, length=await self.database.userquests.count())
+		user_qps = await self.database.userquests.qp_ranking(offset=offset)
 		user_string = []
-		for user_id, count in user_qps:
+		for user_id, name, count in user_qps:
 			offset += 1
-			user = self.database.users.get(user_id)
-			user_string.append(f"`#{offset}`  **{user.name}**  ({count:,})")
+			user_string.append(f"`#{offset}`  **{name}**  ({count:,})")
 		await context.reply(embed=Embeds.simple_embed(None, None, fields=[("List of highest qp users", '\n'.join(user_string))], footer=page_text), mention_author=False)
 
 	@commands.command(aliases=['aqp'], description="Add quest points to a specified user.")
 	@commands.is_owner()
-	async def addquestpoints(self, context, identifier, tier, amount = 1) -> None:
+	async def addquestpoints(self, context, identifier, tier, amount: int = 1) -> None:
 		identifier = context.author.id if not identifier else Data.convert_mention(identifier)
 		try:
-			user_id = self.database.users.search(identifier)
-			user = self.database.users.get(user_id)
+			user_id = await self.database.users.search(identifier)
+			user = await self.database.users.get(user_id)
 			if not tier.isdecimal() or int(tier) < 1 or int(tier) > 5:
 				await context.reply("Could not understand quest tier.", mention_author=False)
 				return
 			tier = int(tier)
-			try:
-				user_quests = self.database.userquests.get(user.id)
-			except:
-				self.database.userquests.create(user.id)
-				user_quests = (user_id, 0, 0, 0, 0, 0)
-			self.database.userquests.update(user.id, Quest.TIERS[tier][0].lower(), user_quests[tier] + amount)
+			await self.database.userquests.update_points(user.id, Quest.TIERS[tier][0].lower(), amount)
 			await context.reply(f"Added {tier * amount} quest points to {user.name}!", mention_author=False)
 		except:
 			await context.reply(f"Could not add quest points.", mention_author=False)
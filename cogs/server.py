@@ -1,8 +1,8 @@
 from discord.ext import commands
 from discord import Status, Game, HTTPException
-from core.database import Connection
+from core.database import AsyncConnection
 from core.common import Roles
-import os
+from core.stats import Stats
 
 # cogs/server.py
 # - (Server) commands.Cog for server and moderation related commands/listeners
@@ -10,8 +10,11 @@ import os
 class Server(commands.Cog):
 	def __init__(self, bot) -> None:
 		self.bot = bot
-		self.database = Connection()
-		self.database.start()
+		self.database = AsyncConnection.shared(bot)
+		self.stats = Stats.shared(bot)
+
+	async def cog_load(self) -> None:
+		await self.database.start()
 
 	@commands.command(aliases=['color'], description="Change your color role.")
 	@commands.cooldown(1, 3, commands.BucketType.user)
@@ -86,21 +89,21 @@ class Server(commands.Cog):
 	@commands.command(aliases=['stats'], description="Returns current stats of the user table.")
 	@commands.has_any_role([Roles.MOD, Roles.ADMIN])
 	async def databasestats(self, context) -> None:
-		stats = f"`Users:{self.database.users.count()}  Badges:{self.database.badges.count()}   Quests:{self.database.quests.count()}`\n"
-		size = 0
-		for path, directories, files in os.walk("."):
-			for file in files:
-				pointer = os.path.join(path, file)
-				size += os.path.getsize(pointer)
-		stats += f"**`{round(size / 1024, 2):,}kB`**"
-		await context.reply(stats, mention_author=False)
+		stats = await self.stats.get()
+		text = f"`{'  '.join(f'{table}:{count}' for table, count in stats['counts'].items())}`\n"
+		text += f"**`{round(stats['bytes'] / 1024, 2):,}kB`** database, {round(stats['free_bytes'] / 1024, 2):,}kB free ({stats['fragmentation']:.1%})"
+		# Free pages are only given back to the disk by a VACUUM
+		if stats["fragmentation"] >= 0.25:
+			text += " - worth vacuuming"
+		text += f"\n**`{round(stats['backup_bytes'] / 1024, 2):,}kB`** backups"
+		await context.reply(text, mention_author=False)
 	
 	@commands.command(aliases=['fear'],  description="")
 	@commands.has_any_role([Roles.MOD, Roles.ADMIN])
 	async def scare(self, context, username=None) -> None:
 		try:
-			mod = self.database.users.search(context.author.id)
-			username = self.database.users.search(username)
+			mod = await self.database.users.search(context.author.id)
+			username = await self.database.users.search(username)
 			scary_string = f"*{mod.name}{"'" if mod.name[-1] == "s" else "'s"} eyes have awoken.*"
 			await context.guild.get_member(username).send(scary_string)
 		except:
@@ -110,7 +113,7 @@ class Server(commands.Cog):
 	@commands.is_owner()
 	async def testing(self, context) -> None:
 		try:
-			self.database.execute("DELETE FROM Users WHERE name = ?", ("ibeefmypants",))
+			await self.database.execute("DELETE FROM Users WHERE name = ?", ("ibeefmypants",))
 		except:
 			await context.reply("Did not run correctly", mention_author=False)
 	
@@ -1,82 +1,189 @@
 from discord.ext import commands, tasks
-from core.database import Connection
-from core.common import Time
+from discord import Object, NotFound, HTTPException
+from discord.utils import snowflake_time
+from core.database import AsyncConnection, Activity
+from core.common import Time, Quest
+from core.images import BadgeImages
+from core.resolver import Resolver
+from core.backups import BackupStore
+from core.scheduler import ExpiryScheduler
+from core.stats import Stats
+import asyncio
 import os
-import shutil
 
 # cogs/tasks.py
 # - (Tasks) commands.Cog primarily holding database task loops
 
 class Tasks(commands.Cog):
+	BULK_DELETE_AGE = 60 * 60 * 24 * 14 - 60 * 60  # Discord only bulk deletes messages under 14 days old, with an hour to spare
+	BULK_DELETE_SIZE = 100  # Most messages a single bulk delete can take
+
 	def __init__(self, bot) -> None:
 		self.bot = bot
-		self.database = Connection()
-		self.database.start()
+		self.database = AsyncConnection.shared(bot)
+		self.resolver = Resolver.shared(bot)
+		self.activity = Activity.shared(bot)
+		self.badge_images = BadgeImages.shared(bot)
+		self.stats = Stats.shared(bot)
+		self.quest_expiry = ExpiryScheduler.shared(bot, 'quests')
+		self.quest_expiry_task = None
+		# BACKUP_RETENTION is the number of hourly, daily and weekly snapshots kept, i.e. "24,7,4"
+		retention = os.environ.get("BACKUP_RETENTION")
+		self.backup_store = BackupStore(retention=dict(zip(BackupStore.RETENTION, map(int, retention.split(','))))) if retention else BackupStore()
 
+	async def cog_load(self) -> None:
+		# Loops only start once the database is ready, as some run immediately
+		await self.database.start()
 		self.backup_database.start()
-		self.delete_temp_files.start()
 		self.cleanup_users.start()
-		self.cleanup_quests.start()
+		await self.schedule_quests()
+		self.quest_expiry_task = asyncio.create_task(self.cleanup_quests())
 
-	@tasks.loop(hours=24)
+	async def schedule_quests(self) -> None:
+		# Quests are removed a while after they expire, the deadlines are then kept up to date by the quest commands
+		self.quest_expiry.clear()
+		for quest_id, expires in await self.database.quests.get_expiry_times():
+			if isinstance(expires, int):
+				self.quest_expiry.schedule(quest_id, expires + Quest.EXPIRED_FOR)
+
+	async def cog_unload(self) -> None:
+		self.backup_database.cancel()
+		self.cleanup_users.cancel()
+		if self.quest_expiry_task:
+			self.quest_expiry_task.cancel()
+
+	@tasks.loop(hours=1)
 	async def backup_database(self) -> None:
 		code = 'TASK:BACKUP >'
 		print(f"{code} Running database backup...")
+		now = Time.current_timestamp()
+		path = f"./backups/{now}.db"
 		try:
-			now = Time.current_timestamp()
-			for path, directories, files in os.walk("./backups"):
-				for file in files:
-					pointer = os.path.join(path, file)
-					if int(os.path.getmtime(pointer)) < (now - 60 * 60 * 24 * 7):
-						os.remove(pointer)
-		except:
-			raise Exception(f"{code} ERROR with backup cleanup.")
-		try:
+			os.makedirs("./backups", exist_ok=True)
 			print(f"{code} Backing up current database.")
-			shutil.copy("./willybot.db", f"./backups/{now}.db")
+			backup = await self.database.backup(path)
+			snapshot = await asyncio.to_thread(self.backup_store.snapshot, path, now)
+			print(f"{code} Backed up {round(backup['bytes'] / 1024, 2):,}kB in {backup['seconds']:.2f}s, {snapshot['written']}/{snapshot['chunks']} chunks new ({round(snapshot['stored'] / 1024, 2):,}kB stored).")
 		except:
 			raise Exception(f"{code} ERROR with backup creation.")
-	
-	@tasks.loop(hours=1)
-	async def delete_temp_files(self) -> None:
-		code = 'TASK:TEMPFILES >'
-		print(f"{code} Running temp file deletion...")
+		finally:
+			if os.path.exists(path):
+				os.remove(path)
 		try:
-			now = Time.current_timestamp()
-			for path, directories, files in os.walk("./temp"):
-				for file in files:
-					pointer = os.path.join(path, file)
-					if int(os.path.getmtime(pointer)) < (now - 60):
-						os.remove(pointer)
+			pruned = await asyncio.to_thread(self.backup_store.prune)
+			print(f"{code} Removed {pruned['snapshots']} old snapshots and {pruned['chunks']} unused chunks ({round(pruned['bytes'] / 1024, 2):,}kB).")
+			# Full copies made before snapshots were chunked are still removed after a week
+			for file in os.listdir("./backups"):
+				pointer = os.path.join("./backups", file)
+				if file.endswith(".db") and int(os.path.getmtime(pointer)) < (now - 60 * 60 * 24 * 7):
+					os.remove(pointer)
+			self.stats.invalidate()
 		except:
-			raise Exception(f"{code} ERROR with temp file deletion.")
+			raise Exception(f"{code} ERROR with backup cleanup.")
+
+	@commands.command(description="List the stored database backups.")
+	@commands.is_owner()
+	async def backups(self, context) -> None:
+		snapshots = await asyncio.to_thread(self.backup_store.list)
+		lines = [f"`{snapshot['name']}`  <t:{snapshot['created']}:f>  {round(snapshot['bytes'] / 1024, 2):,}kB" for snapshot in snapshots[:20]]
+		await context.reply("\n".join(lines) if lines else "No backups stored.", mention_author=False)
 
+	@commands.command(description="Rebuild a database backup, replacing the live database if [live] is given. [NAME|latest] [live]")
+	@commands.is_owner()
+	async def restorebackup(self, context, name: str = "latest", live: str = None) -> None:
+		try:
+			if name == "latest":
+				name = (await asyncio.to_thread(self.backup_store.list))[0]["name"]
+			path = f"./backups/restored/{name}.db"
+			restored = await asyncio.to_thread(self.backup_store.restore, name, path)
+			# The rebuilt copy is kept in the backup folder
+			self.stats.invalidate()
+			if live == "live":
+				# Xp not yet written was earned against the database being replaced, so it's dropped rather than added onto the backup
+				self.activity.clear()
+				await self.database.restore(path)
+				self.stats.invalidate()
+				await self.schedule_quests()
+				self.badge_images.clear()
+				await asyncio.to_thread(self.badge_images.load_all, await self.database.badges.image_list())
+				await context.reply(f"Restored backup `{name}` into the live database.", mention_author=False)
+			else:
+				await context.reply(f"Rebuilt backup `{name}` ({round(restored['bytes'] / 1024, 2):,}kB) at `{path}`.", mention_author=False)
+		except:
+			await context.reply(f"Could not restore backup `{name}`.", mention_author=False)
+	
 	@tasks.loop(hours=24)
 	async def cleanup_users(self):
 		code = 'TASK:USERS >'
 		print(f"{code} Running users table cleanup...")
 		try:
-			self.database.execute("DELETE FROM Users WHERE xp <= 0 AND active <= ?", (Time.current_timestamp() - (60 * 60 * 24 * 30),))
+			# Buffered activity has to be written first, or users who just came back would still look inactive
+			await self.activity.flush()
+			await self.database.users.delete_inactive(Time.current_timestamp() - (60 * 60 * 24 * 30))
+			self.stats.invalidate()
 		except:
 			raise Exception(f"{code} Error with users table cleanup.")
 
-	@tasks.loop(hours=1)
 	async def cleanup_quests(self):
+		# Sleeps until the next quest is due to be removed rather than polling
 		code = 'TASK:QUESTS >'
-		print(f"{code} Running quests table cleanup...")
-		try:
-			expiring_quests = self.database.quests.get_expiring()
-			for quest in expiring_quests:
-				print(quest.name)
+		while True:
+			quest_ids = await self.quest_expiry.wait()
+			print(f"{code} Running quests table cleanup...")
+			try:
+				quests = await self.database.quests.get_many(quest_ids)
+				expiring_quests = []
+				for quest in quests.values():
+					if not isinstance(quest.expires, int):
+						continue
+					if quest.expires + Quest.EXPIRED_FOR <= Time.current_timestamp():
+						expiring_quests.append(quest)
+					else:
+						# Its expiry was pushed back without going through the quest commands
+						self.quest_expiry.schedule(quest.id, quest.expires + Quest.EXPIRED_FOR)
+				if not expiring_quests:
+					continue
+				print(f"{code} Removing {', '.join(quest.name for quest in expiring_quests)}.")
 				try:
-					channel = await self.bot.fetch_channel(915359964158099456)
-					message = await channel.fetch_message(quest.id)
-					await message.delete()
-				except:
-					print(f"{code} Could not get quest message with id of `{quest.id}`.")
-				self.database.quests.delete(quest.id)
-		except:
-			raise Exception(f"{code} Error with quests table cleanup.")
+					channel = await self.resolver.channel(Quest.CHANNEL)
+					deleted = await self.delete_messages(channel, [quest.id for quest in expiring_quests])
+					print(f"{code} Deleted quest messages: {deleted['bulk']} in bulk, {deleted['single']} one by one, {deleted['missing']} already gone, {deleted['failed']} failed.")
+				except Exception:
+					print(f"{code} Could not get quest channel with id of `{Quest.CHANNEL}`.")
+				await self.database.transaction(lambda connection: connection.quests.delete_many([quest.id for quest in expiring_quests]))
+				self.stats.invalidate()
+			# Not a bare except, so cancelling the task (i.e. when the cog is unloaded) stops it instead of retrying
+			except Exception:
+				print(f"{code} Error with quests table cleanup, retrying in 5 minutes.")
+				for quest_id in quest_ids:
+					self.quest_expiry.schedule(quest_id, Time.current_timestamp() + 60 * 5)
+
+	async def delete_messages(self, channel, message_ids: list) -> dict:
+		# Deletes messages by id without fetching them first, in bulk where they're recent enough
+		deleted = {"bulk": 0, "single": 0, "missing": 0, "failed": 0}
+		cutoff = Time.current_timestamp() - Tasks.BULK_DELETE_AGE
+		recent = [_id for _id in message_ids if snowflake_time(_id).timestamp() > cutoff]
+		single = [_id for _id in message_ids if snowflake_time(_id).timestamp() <= cutoff]
+		for i in range(0, len(recent), Tasks.BULK_DELETE_SIZE):
+			chunk = recent[i:i + Tasks.BULK_DELETE_SIZE]
+			if len(chunk) < 2:
+				# A bulk delete needs at least two messages
+				single += chunk
+				continue
+			try:
+				await channel.delete_messages([Object(id=_id) for _id in chunk])
+				deleted["bulk"] += len(chunk)
+			except HTTPException:
+				single += chunk
+		for _id in single:
+			try:
+				await channel.get_partial_message(_id).delete()
+				deleted["single"] += 1
+			except NotFound:
+				deleted["missing"] += 1
+			except HTTPException:
+				deleted["failed"] += 1
+		return deleted
 
 async def setup(bot):
 	await bot.add_cog(Tasks(bot))
\ No newline at end of file
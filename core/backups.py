@@ -0,0 +1,127 @@
+from datetime import datetime, timezone
+import hashlib
+import json
+import os
+import zlib
+
+# core/backups.py
+# - (BackupStore) database snapshots split into compressed chunks stored once by content, with a manifest per snapshot
+
+class BackupStore:
+	PATH = "./backups"
+	CHUNK_SIZE = 64 * 1024  # A multiple of the database page size, so unchanged pages land in identical chunks
+	RETENTION = {"hourly": 24, "daily": 7, "weekly": 4}  # Newest snapshot kept for each of the last N hours/days/weeks
+	BUCKETS = {"hourly": "%Y-%m-%d %H", "daily": "%Y-%m-%d", "weekly": "%G-%V"}
+
+	def __init__(self, path: str = PATH, retention: dict = None) -> None:
+		self.path = path
+		self.chunks = os.path.join(path, "chunks")
+		self.manifests = os.path.join(path, "manifests")
+		self.retention = retention if retention else BackupStore.RETENTION
+
+	def __chunk_path__(self, digest: str) -> str:
+		# Chunks are spread over subfolders by the start of their hash to keep folders small
+		return os.path.join(self.chunks, digest[:2], digest)
+
+	def __manifest_path__(self, name: str) -> str:
+		return os.path.join(self.manifests, f"{name}.json")
+
+	def __write__(self, path: str, data: bytes) -> None:
+		# Written to a temporary file first so a crash never leaves a partial chunk or manifest behind
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(f"{path}.tmp", 'wb') as file:
+			file.write(data)
+		os.replace(f"{path}.tmp", path)
+
+	def snapshot(self, path: str, created: int) -> dict:
+		# Stores the file at path as a snapshot named after its creation timestamp, only writing chunks not already stored
+		chunks, written, stored, size = [], 0, 0, 0
+		digest = hashlib.sha256()
+		with open(path, 'rb') as file:
+			while chunk := file.read(BackupStore.CHUNK_SIZE):
+				size += len(chunk)
+				digest.update(chunk)
+				chunk_digest = hashlib.sha256(chunk).hexdigest()
+				chunks.append(chunk_digest)
+				if not os.path.exists(self.__chunk_path__(chunk_digest)):
+					compressed = zlib.compress(chunk)
+					self.__write__(self.__chunk_path__(chunk_digest), compressed)
+					written += 1
+					stored += len(compressed)
+		manifest = {"name": str(created), "created": created, "bytes": size, "sha256": digest.hexdigest(), "chunks": chunks}
+		self.__write__(self.__manifest_path__(manifest["name"]), json.dumps(manifest).encode())
+		return {"name": manifest["name"], "bytes": size, "chunks": len(chunks), "written": written, "stored": stored}
+
+	def list(self) -> list:
+		# Manifests of every snapshot, newest first
+		if not os.path.isdir(self.manifests):
+			return []
+		manifests = []
+		for file in os.listdir(self.manifests):
+			if file.endswith(".json"):
+				with open(os.path.join(self.manifests, file), 'rb') as manifest:
+					manifests.append(json.load(manifest))
+		return sorted(manifests, key=lambda manifest: manifest["created"], reverse=True)
+
+	def get(self, name: str) -> dict:
+		path = self.__manifest_path__(name)
+		if os.path.basename(name) != name or not os.path.exists(path):
+			raise FileNotFoundError(f"No backup snapshot named \'{name}\'")
+		with open(path, 'rb') as manifest:
+			return json.load(manifest)
+
+	def restore(self, name: str, path: str) -> dict:
+		# Rebuilds the snapshot at path, checking it against the hash of the original file before it is put in place
+		manifest = self.get(name)
+		digest = hashlib.sha256()
+		os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+		try:
+			with open(f"{path}.tmp", 'wb') as file:
+				for chunk_digest in manifest["chunks"]:
+					with open(self.__chunk_path__(chunk_digest), 'rb') as chunk_file:
+						chunk = zlib.decompress(chunk_file.read())
+					digest.update(chunk)
+					file.write(chunk)
+			if digest.hexdigest() != manifest["sha256"]:
+				raise Exception(f"Backup snapshot \'{name}\' does not match its manifest")
+			os.replace(f"{path}.tmp", path)
+		finally:
+			if os.path.exists(f"{path}.tmp"):
+				os.remove(f"{path}.tmp")
+		return {"name": name, "path": path, "bytes": manifest["bytes"]}
+
+	def keep(self, manifests: list) -> set:
+		# Names of the snapshots kept by the retention policy: the newest snapshot in each of the most recent buckets
+		kept = set()
+		for policy, count in self.retention.items():
+			buckets = set()
+			for manifest in manifests:
+				bucket = datetime.fromtimestamp(manifest["created"], timezone.utc).strftime(BackupStore.BUCKETS[policy])
+				if bucket in buckets:
+					continue
+				if len(buckets) >= count:
+					break
+				buckets.add(bucket)
+				kept.add(manifest["name"])
+		return kept
+
+	def prune(self) -> dict:
+		# Removes snapshots outside of the retention policy, then any chunk no remaining snapshot refers to
+		manifests = self.list()
+		kept = self.keep(manifests)
+		referenced = set()
+		for manifest in manifests:
+			if manifest["name"] in kept:
+				referenced.update(manifest["chunks"])
+			else:
+				os.remove(self.__manifest_path__(manifest["name"]))
+		removed, freed = 0, 0
+		if os.path.isdir(self.chunks):
+			for path, directories, files in os.walk(self.chunks):
+				for file in files:
+					if file not in referenced:
+						pointer = os.path.join(path, file)
+						freed += os.path.getsize(pointer)
+						os.remove(pointer)
+						removed += 1
+		return {"snapshots": len(manifests) - len(kept), "chunks": removed, "bytes": freed}
@@ -214,6 +214,7 @@ class Roles:
 
 class Quest:
 	CHANNEL = 915359964158099456
+	EXPIRED_FOR = 60 * 60 * 24  # Seconds an expired quest stays posted before it's removed
 	TIERS = {
 		1: ("Easy", '🟢'), 
 		2: ("Normal", '🔵'),
@@ -1,35 +1,171 @@
 import sqlite3
+import asyncio
+import math
+import os
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from sortedcontainers import SortedList
 from core.common import Time
 
 # core/database.py:
 # - (Connection) database connection/handler 
+# - (AsyncConnection) shared awaitable connection pool running queries on worker threads
+# - (Cache, Ranking, Caches) in-memory caches shared by every connection to the same database
 # - (Types) schema class model for easily interacting with data 
 # - (Tables) namespace implementing table specific methods
+# - (Activity) write-behind buffer for user xp and activity updates
 
 class Connection:
-	def __init__(self) -> None:
+	PATH = "./willybot.db"
+
+	def __init__(self, path: str = PATH, readonly: bool = False, caches: 'Caches' = None) -> None:
+		self.path = path
+		self.readonly = readonly
+		self.caches = caches if caches else Caches()
 		self.connection = None
 		self.cursor = None
+		self.in_transaction = False
+		self.committed = []  # Cache changes waiting for the transaction they follow to commit
+		self.search_tables = None
+		self.metrics = None  # Query times are only recorded once given a Metrics (see AsyncConnection.instrument)
+		self.operation = None  # (table, method) being run, to label recorded query times
 	
 	def start(self):
 		self.__connect__()
-		self.__build__()
+		if not self.readonly:
+			self.__build__()
 	
 	def __connect__(self) -> None:
-		self.connection = sqlite3.connect("./willybot.db")
+		# The connection may be opened and closed from different threads by AsyncConnection
+		if self.readonly:
+			self.connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+		else:
+			self.connection = sqlite3.connect(self.path, check_same_thread=False)
+			# WAL lets readers keep reading while a write is being committed
+			self.connection.execute("PRAGMA journal_mode=WAL")
+			self.connection.execute("PRAGMA synchronous=NORMAL")
 		self.cursor = self.connection.cursor()
 		self.__set_table_commands__()
 
+	def close(self) -> None:
+		if self.connection:
+			self.connection.commit()
+			self.connection.close()
+			self.connection = None
+
 	def __del__(self):
-		self.connection.commit()
-		self.connection.close()
+		self.close()
+
+	def backup(self, path: str) -> dict:
+		# Copies the live database to path and checks the copy, using its own connections
+		# The copy is made in one pass from a single read snapshot: with WAL, writers aren't blocked by it,
+		# whereas copying in steps would restart the backup every time something else writes
+		start = time.perf_counter()
+		source = sqlite3.connect(self.path)
+		target = sqlite3.connect(path)
+		try:
+			source.backup(target)
+			integrity = target.execute("PRAGMA integrity_check").fetchone()[0]
+		finally:
+			target.close()
+			source.close()
+		if integrity != 'ok':
+			os.remove(path)
+			raise Exception(f"Backup failed integrity check: {integrity}")
+		return {"path": path, "seconds": time.perf_counter() - start, "bytes": os.path.getsize(path)}
+
+	def restore(self, path: str) -> None:
+		# Replaces the live database with the one at path, then brings its schema up to date in case it is older
+		source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+		try:
+			integrity = source.execute("PRAGMA integrity_check").fetchone()[0]
+			if integrity != 'ok':
+				raise Exception(f"Restore failed integrity check: {integrity}")
+			self.connection.commit()
+			source.backup(self.connection)
+		finally:
+			source.close()
+		self.__build__()
 	
 	def __build__(self):
-		self.execute("CREATE TABLE IF NOT EXISTS Users (id INTEGER PRIMARY KEY, name TEXT UNIQUE, title TEXT, joined INTEGER, active INTEGER, xp INTEGER DEFAULT 0)")
-		self.execute("CREATE TABLE IF NOT EXISTS Badges (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE, image TEXT, description TEXT)")
-		self.execute("CREATE TABLE IF NOT EXISTS UserBadges (user INTEGER, badge INTEGER, PRIMARY KEY (user, badge), FOREIGN KEY (user) REFERENCES Users(id) ON UPDATE CASCADE, FOREIGN KEY (badge) REFERENCES Badges(id) ON UPDATE CASCADE)")
-		self.execute("CREATE TABLE IF NOT EXISTS Quests (id INTEGER PRIMARY KEY UNIQUE, name TEXT UNIQUE, tier INTEGER, description TEXT, expires INTEGER)")
-		self.execute("CREATE TABLE IF NOT EXISTS UserQuests (user INTEGER, easy INTEGER, normal INTEGER, hard INTEGER, insane INTEGER, extra INTEGER, FOREIGN KEY (user) REFERENCES Users(id) ON UPDATE CASCADE)")
+		# The schema version is kept in the database header, so only migrations newer than it are applied
+		version = self.execute("PRAGMA user_version", fetch=1)
+		if version >= len(Connection.MIGRATIONS):
+			return
+		with self.transaction():
+			for migration in Connection.MIGRATIONS[version:]:
+				for step in migration:
+					if isinstance(step, str):
+						self.execute(step)
+					else:
+						step(self)
+			self.execute(f"PRAGMA user_version = {len(Connection.MIGRATIONS)}")
+		# Refresh the query planner's statistics now that the tables or indexes have changed
+		self.execute("ANALYZE")
+		self.execute("PRAGMA optimize")
+
+	# Quest points are a generated column so that rankings can use an index instead of computing them per row
+	USERQUESTS_SCHEMA = "user INTEGER PRIMARY KEY, easy INTEGER DEFAULT 0, normal INTEGER DEFAULT 0, hard INTEGER DEFAULT 0, insane INTEGER DEFAULT 0, extra INTEGER DEFAULT 0, points INTEGER GENERATED ALWAYS AS (easy * 1 + normal * 2 + hard * 3 + insane * 4 + extra * 5) VIRTUAL, FOREIGN KEY (user) REFERENCES Users(id) ON UPDATE CASCADE"
+
+	def __upgrade_userquests__(self):
+		# Older tables have no points column or primary key, so rebuild the table merging any duplicate users
+		columns = self.execute("SELECT name FROM pragma_table_xinfo('UserQuests')", fetch=True)
+		if ('points',) in columns:
+			return
+		self.execute("ALTER TABLE UserQuests RENAME TO UserQuestsOld")
+		self.execute(f"CREATE TABLE UserQuests ({Connection.USERQUESTS_SCHEMA})")
+		self.execute("INSERT INTO UserQuests (user, easy, normal, hard, insane, extra) SELECT user, SUM(COALESCE(easy, 0)), SUM(COALESCE(normal, 0)), SUM(COALESCE(hard, 0)), SUM(COALESCE(insane, 0)), SUM(COALESCE(extra, 0)) FROM UserQuestsOld WHERE user IS NOT NULL GROUP BY user")
+		self.execute("DROP TABLE UserQuestsOld")
+
+	SEARCHABLE = ('Badges', 'Quests')  # Tables with a full-text search index named {table}Search
+
+	def __create_search__(self):
+		# Trigram full-text indexes over names and descriptions, kept in sync with their table by triggers
+		for table in Connection.SEARCHABLE:
+			try:
+				self.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}Search USING fts5(name, description, content='{table}', content_rowid='id', tokenize='trigram')")
+			except:
+				# Needs sqlite 3.34 or newer, searching falls back to LIKE without it
+				print(f"Could not create full-text search index for {table}.")
+				continue
+			self.execute(f"CREATE TRIGGER IF NOT EXISTS {table}SearchInsert AFTER INSERT ON {table} BEGIN INSERT INTO {table}Search (rowid, name, description) VALUES (new.id, new.name, new.description); END")
+			self.execute(f"CREATE TRIGGER IF NOT EXISTS {table}SearchDelete AFTER DELETE ON {table} BEGIN INSERT INTO {table}Search ({table}Search, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); END")
+			self.execute(f"CREATE TRIGGER IF NOT EXISTS {table}SearchUpdate AFTER UPDATE ON {table} BEGIN INSERT INTO {table}Search ({table}Search, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); INSERT INTO {table}Search (rowid, name, description) VALUES (new.id, new.name, new.description); END")
+			self.execute(f"INSERT INTO {table}Search ({table}Search) VALUES ('rebuild')")
+
+	# Ordered list of migrations, each a list of statements (or functions taking the connection)
+	# Never edit or reorder existing migrations, add a new one to the end instead
+	MIGRATIONS = [
+		# 1: Original tables
+		[
+			"CREATE TABLE IF NOT EXISTS Users (id INTEGER PRIMARY KEY, name TEXT UNIQUE, title TEXT, joined INTEGER, active INTEGER, xp INTEGER DEFAULT 0)",
+			"CREATE TABLE IF NOT EXISTS Badges (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE, image TEXT, description TEXT)",
+			"CREATE TABLE IF NOT EXISTS UserBadges (user INTEGER, badge INTEGER, PRIMARY KEY (user, badge), FOREIGN KEY (user) REFERENCES Users(id) ON UPDATE CASCADE, FOREIGN KEY (badge) REFERENCES Badges(id) ON UPDATE CASCADE)",
+			"CREATE TABLE IF NOT EXISTS Quests (id INTEGER PRIMARY KEY UNIQUE, name TEXT UNIQUE, tier INTEGER, description TEXT, expires INTEGER)",
+			"CREATE TABLE IF NOT EXISTS UserQuests (user INTEGER, easy INTEGER, normal INTEGER, hard INTEGER, insane INTEGER, extra INTEGER, FOREIGN KEY (user) REFERENCES Users(id) ON UPDATE CASCADE)"
+		],
+		# 2: UserQuests primary key and indexed quest points
+		[
+			__upgrade_userquests__,
+			"CREATE INDEX IF NOT EXISTS UserQuestsPoints ON UserQuests (points)"
+		],
+		# 3: Indexes for xp rankings, inactive user cleanup, username lookups, badge owners and quest expiry
+		[
+			"CREATE INDEX IF NOT EXISTS UsersXp ON Users (xp)",
+			"CREATE INDEX IF NOT EXISTS UsersActive ON Users (active)",
+			"CREATE INDEX IF NOT EXISTS UsersName ON Users (name COLLATE NOCASE)",
+			"CREATE INDEX IF NOT EXISTS UserBadgesBadge ON UserBadges (badge)",
+			"CREATE INDEX IF NOT EXISTS QuestsExpires ON Quests (expires)"
+		],
+		# 4: Full-text search for badges and quests
+		[
+			__create_search__
+		]
+	]
 
 	def __set_table_commands__(self):
 		self.users = Tables.Users(self)
@@ -39,9 +175,23 @@ class Connection:
 		self.userquests = Tables.UserQuests(self)
 
 	def execute(self, command: str, values: tuple = (), fetch = False):
+		if self.metrics is not None:
+			return self.__observe__(self.__execute__, command, values, fetch)
+		return self.__execute__(command, values, fetch)
+
+	def __observe__(self, function, *args):
+		table, method = self.operation if self.operation else ('', args[0].split(None, 1)[0].upper())
+		start = time.perf_counter()
+		try:
+			return function(*args)
+		finally:
+			self.metrics.observe("database_query_seconds", time.perf_counter() - start, table=table, method=method)
+
+	def __execute__(self, command: str, values: tuple = (), fetch = False):
 		try:
 			self.cursor = self.cursor.execute(command, values)
-			self.connection.commit()
+			if not self.in_transaction:
+				self.connection.commit()
 			# fetch True should return ALL from table
 			if fetch:
 				if isinstance(fetch, bool):
@@ -58,10 +208,61 @@ class Connection:
 				return
 		except:
 			raise Exception("Error in Connection.execute()")
+
+	def execute_many(self, command: str, values: list) -> None:
+		if self.metrics is not None:
+			return self.__observe__(self.__execute_many__, command, values)
+		return self.__execute_many__(command, values)
+
+	def __execute_many__(self, command: str, values: list) -> None:
+		# Runs the same command for every tuple in values under a single commit
+		try:
+			self.cursor.executemany(command, values)
+			if not self.in_transaction:
+				self.connection.commit()
+		except:
+			if not self.in_transaction:
+				self.connection.rollback()
+			raise Exception("Error in Connection.execute_many()")
+
+	@contextmanager
+	def transaction(self):
+		# Statements inside the block share one commit, and are all rolled back if any of them fail
+		if self.in_transaction:
+			# Nested blocks just become part of the outer transaction
+			yield self
+			return
+		self.in_transaction = True
+		try:
+			# Begin explicitly, otherwise sqlite3 would leave schema changes outside the transaction
+			if not self.connection.in_transaction:
+				self.connection.execute("BEGIN")
+			yield self
+			self.connection.commit()
+		except:
+			self.connection.rollback()
+			raise
+		finally:
+			self.in_transaction = False
+			committed, self.committed = self.committed, []
+		# Only reached once committed, changes queued by a transaction that was rolled back are dropped
+		for function in committed:
+			function()
+
+	def on_commit(self, function, *args) -> None:
+		# Runs function once what was just executed is committed, so caches never hold changes that could still be rolled back
+		if self.in_transaction:
+			self.committed.append(partial(function, *args))
+		else:
+			function(*args)
 	
 	def create(self, table: str, attributes: tuple, values: tuple) -> None:
 		command = f"INSERT INTO {table} ({','.join(attributes)}) VALUES ({','.join(['?'] * len(attributes))})"
 		self.execute(command, values)
+
+	def create_many(self, table: str, attributes: tuple, values: list) -> None:
+		command = f"INSERT INTO {table} ({','.join(attributes)}) VALUES ({','.join(['?'] * len(attributes))})"
+		self.execute_many(command, values)
 	
 	def get(self, table: str, _id: int, key: str = 'id') -> tuple:
 		command = f"SELECT * FROM {table} WHERE {key} = ?"
@@ -70,6 +271,15 @@ class Connection:
 		except:
 			raise NotFound(f"Could not find {table} entries with key {key}.")
 	
+	def get_many(self, table: str, ids: list, key: str = 'id') -> list:
+		# Rows are returned in no particular order, and missing ids are skipped
+		rows = []
+		ids = list(ids)
+		for i in range(0, len(ids), 500):  # Keep under sqlite's limit on parameters per statement
+			chunk = ids[i:i + 500]
+			rows += self.execute(f"SELECT * FROM {table} WHERE {key} IN ({','.join(['?'] * len(chunk))})", tuple(chunk), fetch=True)
+		return rows
+
 	def get_specific(self, table: str, attributes: tuple, values: tuple) -> tuple:
 		command = f"SELECT * FROM {table} WHERE {' AND '.join([x + ' = ?' for x in attributes])}"
 		try:
@@ -84,6 +294,9 @@ class Connection:
 		else:
 			if strict:
 				command = f"SELECT id FROM {table} WHERE name = ? COLLATE NOCASE"
+			elif len(identifier) >= 3 and table in self.__search_tables__():
+				# Best match first: an exact name, then by relevance with name matches counting more than descriptions
+				return self.search_ranked(table, identifier, size=1)[0]
 			else:
 				command = f"SELECT id FROM {table} WHERE LOWER(name) LIKE LOWER(?)"
 				identifier = f"%{identifier}%"
@@ -96,25 +309,175 @@ class Connection:
 		else:
 			return _id
 	
+	def __search_tables__(self) -> list:
+		if self.search_tables is None:
+			self.search_tables = [x[0][:-len('Search')] for x in self.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE '%Search'", fetch=True)]
+		return self.search_tables
+
+	def search_ranked(self, table: str, text: str, size: int = 10) -> list:
+		# Ids of entries whose name or description contains text (at least 3 characters), best matches first
+		phrase = '"' + text.replace('"', '""') + '"'
+		command = f"SELECT s.rowid FROM {table}Search s INNER JOIN {table} t ON t.id = s.rowid WHERE {table}Search MATCH ? ORDER BY (t.name = ? COLLATE NOCASE) DESC, bm25({table}Search, 10.0, 1.0) LIMIT ?"
+		ids = [x[0] for x in self.execute(command, (phrase, text, size), fetch=True)]
+		if not ids:
+			raise NotFound(f"Could not find {table} entry with identifier {text}.")
+		return ids
+
 	def update(self, table: str, attributes: tuple, attribute: str, _id: int, value, key: str = 'id') -> None:
 		if attribute in attributes:
 			command = f"UPDATE {table} SET {attribute} = ? WHERE {key} = ?"
 			self.execute(command, (value, _id))
 		else:
 			raise NotFound(f"No column \'{attribute}\' in table {table}")
+
+	def update_many(self, table: str, attributes: tuple, attribute: str, values: list, key: str = 'id') -> None:
+		# values is a list of (id, value) pairs
+		if attribute in attributes:
+			command = f"UPDATE {table} SET {attribute} = ? WHERE {key} = ?"
+			self.execute_many(command, [(value, _id) for _id, value in values])
+		else:
+			raise NotFound(f"No column \'{attribute}\' in table {table}")
 		
 	def delete(self, table: str, _id: int, key: str = 'id') -> None:
 		command = f"DELETE FROM {table} WHERE {key} = ?"
 		self.execute(command, (_id,))
+
+	def delete_many(self, table: str, ids: list, key: str = 'id') -> None:
+		command = f"DELETE FROM {table} WHERE {key} = ?"
+		self.execute_many(command, [(_id,) for _id in ids])
 	
-	def delete_specific(self, table: str, attributes: tuple, values: tuple) -> tuple:
+	def delete_specific(self, table: str, attributes: tuple, values: tuple) -> None:
 		command = f"DELETE FROM {table} WHERE {' AND '.join([x + ' = ?' for x in attributes])}"
-		return self.execute(command, values, fetch=1)
+		self.execute(command, values)
 
 	def count(self, table: str, key: str = 'id', distinct = False) -> int:
 		command = f"SELECT COUNT({'DISTINCT ' + key if distinct else key}) as count FROM {table}"
 		return self.execute(command, fetch=1)
 
+	TABLES = ('Users', 'Badges', 'UserBadges', 'Quests', 'UserQuests')
+
+	def count_all(self) -> dict:
+		# Row counts of every table in a single query
+		command = "SELECT " + ", ".join(f"(SELECT COUNT(*) FROM {table})" for table in Connection.TABLES)
+		return dict(zip(Connection.TABLES, self.execute(command, fetch=True)[0]))
+
+	def storage(self) -> dict:
+		# Size of the database file from its header, and how much of it is free pages left behind by deletes
+		page_count = self.execute("PRAGMA page_count", fetch=1)
+		page_size = self.execute("PRAGMA page_size", fetch=1)
+		freelist_count = self.execute("PRAGMA freelist_count", fetch=1)
+		return {"page_count": page_count, "page_size": page_size, "freelist_count": freelist_count, "bytes": page_count * page_size, "free_bytes": freelist_count * page_size}
+
+
+
+class AsyncConnection:
+	READERS = 4  # How many read-only connections can query alongside the writer
+	WRITES = ('create', 'update', 'delete')  # Table methods that must go through the writer
+
+	def __init__(self, path: str = Connection.PATH, readers: int = READERS) -> None:
+		self.path = path
+		self.caches = Caches()
+		self.writer = Connection(path, caches=self.caches)
+		self.readers = []
+		self.local = threading.local()
+		self.starting = None
+		# A single writer keeps every write on the same thread in the order it was awaited
+		self.write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database-write")
+		self.read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="database-read", initializer=self.__open_reader__)
+		self.users = Tables.Async(self, 'users')
+		self.badges = Tables.Async(self, 'badges')
+		self.userbadges = Tables.Async(self, 'userbadges')
+		self.quests = Tables.Async(self, 'quests')
+		self.userquests = Tables.Async(self, 'userquests')
+
+	def shared(bot) -> 'AsyncConnection':
+		# Kept on the bot instead of the cog so that reloading cogs never reopens the database
+		if not hasattr(bot, 'database'):
+			bot.database = AsyncConnection()
+		return bot.database
+
+	def __open_reader__(self) -> None:
+		self.local.connection = Connection(self.path, readonly=True, caches=self.caches)
+		self.local.connection.metrics = self.writer.metrics
+		self.local.connection.start()
+		self.readers.append(self.local.connection)
+
+	async def start(self) -> None:
+		# Every cog awaits this on load, but the writer only has to be started once
+		if not self.starting:
+			self.starting = asyncio.ensure_future(self.run(self.__start_writer__))
+		await self.starting
+
+	def __start_writer__(self) -> None:
+		self.writer.start()
+		self.writer.users.load_ranking()
+
+	def close(self) -> None:
+		self.write_executor.shutdown(wait=True)
+		self.read_executor.shutdown(wait=True)
+		for connection in [self.writer, *self.readers]:
+			connection.close()
+
+	async def run(self, function, *args, **kwargs):
+		return await asyncio.get_running_loop().run_in_executor(self.write_executor, partial(function, *args, **kwargs))
+
+	async def read(self, function, *args, **kwargs):
+		# function is given the calling thread's read-only connection as its first argument
+		return await asyncio.get_running_loop().run_in_executor(self.read_executor, lambda: function(self.local.connection, *args, **kwargs))
+
+	def instrument(self, metrics) -> None:
+		# Records the time of every query, labelled with the table method that ran it, from now on
+		for connection in [self.writer, *self.readers]:
+			connection.metrics = metrics
+
+	def __call_table__(self, connection: Connection, table: str, method: str, *args, **kwargs):
+		connection.operation = (table, method)
+		try:
+			return getattr(getattr(connection, table), method)(*args, **kwargs)
+		finally:
+			connection.operation = None
+
+	async def call(self, table: str, method: str, *args, **kwargs):
+		if method.startswith(AsyncConnection.WRITES):
+			return await self.run(self.__call_table__, self.writer, table, method, *args, **kwargs)
+		return await self.read(self.__call_table__, table, method, *args, **kwargs)
+
+	async def execute(self, command: str, values: tuple = (), fetch = False):
+		try:
+			return await self.run(self.writer.execute, command, values, fetch)
+		finally:
+			# Raw statements could change anything, so nothing cached can be trusted afterwards
+			if not command.lstrip().upper().startswith('SELECT'):
+				await self.run(self.__reset_caches__)
+
+	async def execute_many(self, command: str, values: list) -> None:
+		try:
+			await self.run(self.writer.execute_many, command, values)
+		finally:
+			await self.run(self.__reset_caches__)
+
+	def __reset_caches__(self) -> None:
+		self.caches.clear()
+		self.writer.users.load_ranking()
+
+	async def backup(self, path: str) -> dict:
+		# Runs on its own thread rather than the writer's, so writes carry on while it copies
+		return await asyncio.to_thread(self.writer.backup, path)
+
+	async def restore(self, path: str) -> None:
+		# Runs on the writer so no other write can interleave, and nothing cached from before can be trusted afterwards
+		def run_restore():
+			self.writer.restore(path)
+			self.__reset_caches__()
+		await self.run(run_restore)
+
+	async def transaction(self, function, *args, **kwargs):
+		# function is given the writer connection, and everything it runs is committed together
+		def run_transaction():
+			with self.writer.transaction():
+				return function(self.writer, *args, **kwargs)
+		return await self.run(run_transaction)
+
 
 
 class NotFound(Exception):
@@ -122,6 +485,133 @@ class NotFound(Exception):
 
 
 
+class Cache:
+	SIZE = 1024  # Most entries kept before the least recently used is dropped
+
+	def __init__(self, size: int = SIZE, weigh = None) -> None:
+		# With weigh (e.g. len), size limits the total weight of the entries instead of how many there are
+		self.size = size
+		self.weigh = weigh if weigh else (lambda value: 1)
+		self.weight = 0
+		self.entries = OrderedDict()
+		# Readers and the writer run on different threads
+		self.lock = threading.Lock()
+		# Bumped on every invalidation, so a value read before a write can't be stored after it
+		self.version = 0
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		with self.lock:
+			if key in self.entries:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return self.entries[key]
+			self.misses += 1
+			return None
+
+	def put(self, key, value, version: int = None) -> None:
+		# Leaving out version is only safe for values that can't go stale, i.e. ones computed purely from their key
+		with self.lock:
+			if version is not None and version != self.version:
+				return
+			if key in self.entries:
+				self.weight -= self.weigh(self.entries[key])
+			self.entries[key] = value
+			self.entries.move_to_end(key)
+			self.weight += self.weigh(value)
+			while self.weight > self.size and self.entries:
+				self.weight -= self.weigh(self.entries.popitem(last=False)[1])
+
+	def invalidate(self, *keys) -> None:
+		with self.lock:
+			self.version += 1
+			for key in keys:
+				if key in self.entries:
+					self.weight -= self.weigh(self.entries.pop(key))
+
+	def clear(self) -> None:
+		with self.lock:
+			self.version += 1
+			self.entries.clear()
+			self.weight = 0
+
+	def stats(self) -> dict:
+		total = self.hits + self.misses
+		return {"size": len(self.entries), "weight": self.weight, "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0}
+
+class Ranking:
+	# Scores kept sorted highest first, so ranks and pages are found with a binary search
+	def __init__(self) -> None:
+		self.scores = {}  # id -> score
+		self.ranked = SortedList()  # (-score, id)
+		self.lock = threading.Lock()
+		# A cold ranking has not been loaded (or was cleared), and should not be used
+		self.loaded = False
+
+	def load(self, rows: list) -> None:
+		with self.lock:
+			self.scores = {_id: score for _id, score in rows}
+			self.ranked = SortedList((-score, _id) for _id, score in self.scores.items())
+			self.loaded = True
+
+	def clear(self) -> None:
+		with self.lock:
+			self.scores = {}
+			self.ranked = SortedList()
+			self.loaded = False
+
+	def set(self, _id: int, score: int) -> None:
+		with self.lock:
+			if not self.loaded:
+				return
+			if _id in self.scores:
+				self.ranked.remove((-self.scores[_id], _id))
+			self.scores[_id] = score
+			self.ranked.add((-score, _id))
+
+	def add(self, _id: int, amount: int) -> None:
+		with self.lock:
+			if not self.loaded or _id not in self.scores:
+				return
+			self.ranked.remove((-self.scores[_id], _id))
+			self.scores[_id] += amount
+			self.ranked.add((-self.scores[_id], _id))
+
+	def remove(self, *ids) -> None:
+		with self.lock:
+			if not self.loaded:
+				return
+			for _id in ids:
+				if _id in self.scores:
+					self.ranked.remove((-self.scores.pop(_id), _id))
+
+	def rank(self, score: int) -> int:
+		# How many ids have a score greater than or equal to the given score
+		with self.lock:
+			return self.ranked.bisect_right((-score, math.inf))
+
+	def page(self, offset: int = 0, size: int = 10) -> list:
+		with self.lock:
+			return [(_id, -score) for score, _id in self.ranked.islice(offset, offset + size)]
+
+class Caches:
+	PROFILE_BYTES = 32 * 1024 * 1024  # Memory allowed for rendered profile images
+
+	def __init__(self) -> None:
+		self.users = Cache()  # user id -> Users row
+		self.xp = Ranking()  # user id -> xp
+		self.badges = Cache()  # user id -> list of badge images
+		self.profiles = Cache(Caches.PROFILE_BYTES, weigh=len)  # (badge images, bar width, level color) -> PNG bytes
+
+	def clear(self) -> None:
+		self.users.clear()
+		self.xp.clear()
+		self.badges.clear()
+		self.profiles.clear()
+
+
+
 class Types:
 	class User:
 		def __init__(self, id: int = None, name: str = None, title: str = None, joined: int = None, active: int = None, xp: int = 0) -> None:
@@ -148,6 +638,15 @@ class Types:
 			self.expires = expires
 
 class Tables:
+	class Async:
+		# Wraps a table so every method call returns an awaitable run on one of the pool's workers
+		def __init__(self, connection: AsyncConnection, table: str):
+			self.connection = connection
+			self.table = table
+
+		def __getattr__(self, name: str):
+			return partial(self.connection.call, self.table, name)
+
 	class Table:
 		def __init__(self, connection: Connection, name: str, attributes: tuple, key: str = 'id'):
 			self.connection = connection
@@ -161,6 +660,16 @@ class Tables:
 		def update(self, _id: int, attribute: str, value) -> None:
 			self.connection.update(self.name, self.attributes, attribute, _id, value, key=self.key)
 
+		def create_many(self, rows: list) -> None:
+			# rows are tuples with a value for every attribute of the table
+			self.connection.create_many(self.name, self.attributes, rows)
+
+		def update_many(self, attribute: str, values: list) -> None:
+			self.connection.update_many(self.name, self.attributes, attribute, values, key=self.key)
+
+		def delete_many(self, ids: list) -> None:
+			self.connection.delete_many(self.name, ids, key=self.key)
+
 		def count(self) -> int:
 			return self.connection.count(self.name, key=self.key)
 	
@@ -175,6 +684,19 @@ class Tables:
 		def get(self, _id: int):
 			return self.type(*(self.connection.get(self.name, _id)))
 
+		def get_many(self, ids: list) -> dict:
+			# Returns an id -> item dict, leaving out any ids that could not be found
+			return {row[0]: self.type(*row) for row in self.connection.get_many(self.name, ids)}
+
+		def row(self, item) -> tuple:
+			return tuple(getattr(item, attribute) for attribute in self.attributes)
+
+		def create(self, item) -> None:
+			self.connection.create(self.name, self.attributes, self.row(item))
+
+		def create_many(self, items: list) -> None:
+			self.connection.create_many(self.name, self.attributes, [self.row(item) for item in items])
+
 	class RelationTable(Table):
 		def __init__(self, connection, name, attributes):
 			super().__init__(connection, name, attributes, key = 'user')
@@ -186,18 +708,104 @@ class Tables:
 		def __init__(self, connection: Connection):
 			super().__init__(connection, name='Users', attributes=('id', 'name', 'title', 'joined', 'active', 'xp'), type=Types.User)
 
-		def create(self, user: Types.User) -> None:
-			self.connection.create(self.name, self.attributes, (user.id, user.name, None, user.joined, user.active, 0))
+		def row(self, user: Types.User) -> tuple:
+			return (user.id, user.name, None, user.joined, user.active, 0)
 
 		def search(self, identifier) -> int:
 			return self.connection.search(self.name, identifier, strict=True)
+
+		# Rows are cached rather than Types.User so callers can never modify a cached user
+		def get(self, _id: int) -> Types.User:
+			cache = self.connection.caches.users
+			row = cache.get(_id)
+			if row is None:
+				version = cache.version
+				row = self.connection.get(self.name, _id)
+				cache.put(_id, row, version)
+			return self.type(*row)
+
+		def get_many(self, ids: list) -> dict:
+			cache = self.connection.caches.users
+			rows = {}
+			missing = []
+			for _id in ids:
+				row = cache.get(_id)
+				if row is None:
+					missing.append(_id)
+				else:
+					rows[_id] = row
+			if missing:
+				version = cache.version
+				for row in self.connection.get_many(self.name, missing):
+					cache.put(row[0], row, version)
+					rows[row[0]] = row
+			return {_id: self.type(*row) for _id, row in rows.items()}
+
+		def create(self, user: Types.User) -> None:
+			super().create(user)
+			self.connection.on_commit(self.connection.caches.users.invalidate, user.id)
+			self.connection.on_commit(self.connection.caches.xp.set, user.id, 0)
+
+		def create_many(self, users: list) -> None:
+			super().create_many(users)
+			self.connection.on_commit(self.connection.caches.users.invalidate, *[user.id for user in users])
+			for user in users:
+				self.connection.on_commit(self.connection.caches.xp.set, user.id, 0)
+
+		def update(self, _id: int, attribute: str, value) -> None:
+			super().update(_id, attribute, value)
+			self.connection.on_commit(self.connection.caches.users.invalidate, _id)
+			if attribute == 'xp':
+				self.connection.on_commit(self.connection.caches.xp.set, _id, value)
+
+		def update_many(self, attribute: str, values: list) -> None:
+			super().update_many(attribute, values)
+			self.connection.on_commit(self.connection.caches.users.invalidate, *[_id for _id, value in values])
+			if attribute == 'xp':
+				for _id, value in values:
+					self.connection.on_commit(self.connection.caches.xp.set, _id, value)
+
+		def delete(self, _id: int) -> None:
+			super().delete(_id)
+			self.connection.on_commit(self.connection.caches.users.invalidate, _id)
+			self.connection.on_commit(self.connection.caches.xp.remove, _id)
+
+		def delete_many(self, ids: list) -> None:
+			super().delete_many(ids)
+			self.connection.on_commit(self.connection.caches.users.invalidate, *ids)
+			self.connection.on_commit(self.connection.caches.xp.remove, *ids)
 		
 		# Custom
+		def update_activity(self, values: list) -> None:
+			# values is a list of (xp gained, last active, id) tuples
+			self.connection.execute_many("UPDATE Users SET xp = xp + ?, active = ? WHERE id = ?", values)
+			self.connection.on_commit(self.connection.caches.users.invalidate, *[_id for xp, active, _id in values])
+			for xp, active, _id in values:
+				self.connection.on_commit(self.connection.caches.xp.add, _id, xp)
+
+		def delete_inactive(self, active: int) -> list:
+			# Deletes users who never earned xp and haven't been active since the given timestamp
+			with self.connection.transaction():
+				ids = [x[0] for x in self.connection.execute("SELECT id FROM Users WHERE xp <= 0 AND active <= ?", (active,), fetch=True)]
+				self.delete_many(ids)
+			return ids
+
+		def load_ranking(self) -> None:
+			self.connection.caches.xp.load(self.connection.execute("SELECT id, COALESCE(xp, 0) FROM Users", fetch=True))
+
+		# The in-memory ranking is used once loaded, otherwise these fall back to querying the table
 		def xp_rank(self, xp: int) -> int:
+			if self.connection.caches.xp.loaded:
+				return self.connection.caches.xp.rank(xp)
 			return self.connection.execute("SELECT COUNT(id) FROM Users WHERE xp >= ?", (xp,), fetch=1)
 		
 		def xp_ranking(self, offset: int = 0, size: int = 10) -> list:
-			return self.connection.execute("SELECT id, xp FROM Users ORDER BY xp DESC LIMIT ? OFFSET ?", (size, offset), fetch=True)
+			# Returns (id, name, xp) tuples
+			if self.connection.caches.xp.loaded:
+				page = self.connection.caches.xp.page(offset, size)
+				users = self.get_many([_id for _id, xp in page])
+				return [(_id, users[_id].name if _id in users else None, xp) for _id, xp in page]
+			return self.connection.execute("SELECT id, name, xp FROM Users ORDER BY xp DESC LIMIT ? OFFSET ?", (size, offset), fetch=True)
 
 		def distinct_title_list(self) -> list:
 			return self.connection.execute("SELECT DISTINCT title FROM Users ORDER BY title", fetch=True)
@@ -206,8 +814,33 @@ class Tables:
 		def __init__(self, connection):
 			super().__init__(connection, name='Badges', attributes=('id', 'name', 'image', 'description'), type=Types.Badge)
 
-		def create(self, badge: Types.Badge) -> None:
-			self.connection.create(self.name, self.attributes, (None, badge.name, badge.image, badge.description))
+		def row(self, badge: Types.Badge) -> tuple:
+			return (None, badge.name, badge.image, badge.description)
+
+		# Custom
+		def image_list(self) -> list:
+			return [x[0] for x in self.connection.execute("SELECT DISTINCT image FROM Badges", fetch=True)]
+
+		# Changing or removing a badge can change any user's badge images
+		def update(self, _id: int, attribute: str, value) -> None:
+			super().update(_id, attribute, value)
+			self.connection.on_commit(self.connection.caches.badges.clear)
+			self.connection.on_commit(self.connection.caches.profiles.clear)
+
+		def update_many(self, attribute: str, values: list) -> None:
+			super().update_many(attribute, values)
+			self.connection.on_commit(self.connection.caches.badges.clear)
+			self.connection.on_commit(self.connection.caches.profiles.clear)
+
+		def delete(self, _id: int) -> None:
+			super().delete(_id)
+			self.connection.on_commit(self.connection.caches.badges.clear)
+			self.connection.on_commit(self.connection.caches.profiles.clear)
+
+		def delete_many(self, ids: list) -> None:
+			super().delete_many(ids)
+			self.connection.on_commit(self.connection.caches.badges.clear)
+			self.connection.on_commit(self.connection.caches.profiles.clear)
 	
 	class UserBadges(RelationTable):
 		def __init__(self, connection):
@@ -215,12 +848,24 @@ class Tables:
 
 		def create(self, user_id: int, badge_id: int) -> None:
 			self.connection.create(self.name, self.attributes, (user_id, badge_id))
+			self.connection.on_commit(self.connection.caches.badges.invalidate, user_id)
+
+		def create_many(self, pairs: list) -> None:
+			# pairs is a list of (user id, badge id) tuples
+			super().create_many(pairs)
+			self.connection.on_commit(self.connection.caches.badges.invalidate, *[user_id for user_id, badge_id in pairs])
 
 		def get(self, user_id: int, badge_id: int) -> tuple:
 			return self.connection.get_specific(self.name, ('user', 'badge'), (user_id, badge_id))
 		
 		def delete(self, user_id: int, badge_id: int) -> None:
 			self.connection.delete_specific(self.name, ('user', 'badge'), (user_id, badge_id))
+			self.connection.on_commit(self.connection.caches.badges.invalidate, user_id)
+
+		def delete_many(self, pairs: list) -> None:
+			# pairs is a list of (user id, badge id) tuples
+			self.connection.execute_many("DELETE FROM UserBadges WHERE user = ? AND badge = ?", pairs)
+			self.connection.on_commit(self.connection.caches.badges.invalidate, *[user_id for user_id, badge_id in pairs])
 
 		def count_users(self) -> int:
 			return self.connection.count(self.name, key='user', distinct=True)
@@ -230,23 +875,28 @@ class Tables:
 
 		#Custom
 		def get_image_list(self, user_id: int) -> list:
-			return self.connection.execute("SELECT image FROM UserBadges ub INNER JOIN Badges b ON ub.badge = b.id WHERE ub.user = ?", (user_id,), fetch=True)
+			cache = self.connection.caches.badges
+			images = cache.get(user_id)
+			if images is None:
+				version = cache.version
+				images = self.connection.execute("SELECT image FROM UserBadges ub INNER JOIN Badges b ON ub.badge = b.id WHERE ub.user = ?", (user_id,), fetch=True)
+				cache.put(user_id, images, version)
+			return list(images)
 		
 		def user_list(self, badge_id: int) -> list:
 			return self.connection.execute("SELECT name FROM UserBadges ub INNER JOIN Users u ON ub.user = u.id WHERE badge = ?", (badge_id,), fetch=True)
 		
 		def badge_counts(self, offset: int = 0, size: int = 10) -> list:
-			return self.connection.execute("SELECT badge, COUNT(badge) AS count FROM UserBadges GROUP BY badge ORDER BY count DESC LIMIT ? OFFSET ?", (size, offset), fetch=True)
+			# Returns (badge id, name, description, count) tuples
+			return self.connection.execute("SELECT ub.badge, b.name, b.description, COUNT(ub.badge) AS count FROM UserBadges ub LEFT JOIN Badges b ON ub.badge = b.id GROUP BY ub.badge ORDER BY count DESC LIMIT ? OFFSET ?", (size, offset), fetch=True)
 		
 		def user_counts(self, offset: int = 0, size: int = 10) -> list:
-			return  self.connection.execute("SELECT user, COUNT(user) AS count FROM UserBadges GROUP BY user ORDER BY count DESC LIMIT ? OFFSET ?", (size, offset), fetch=True)
+			# Returns (user id, name, count) tuples
+			return self.connection.execute("SELECT ub.user, u.name, COUNT(ub.user) AS count FROM UserBadges ub LEFT JOIN Users u ON ub.user = u.id GROUP BY ub.user ORDER BY count DESC LIMIT ? OFFSET ?", (size, offset), fetch=True)
 
 	class Quests(BaseTable):
 		def __init__(self, connection):
 			super().__init__(connection, name='Quests', attributes=('id', 'name', 'tier', 'description', 'expires'), type=Types.Quest)
-
-		def create(self, quest: Types.Quest) -> None:
-			self.connection.create(self.name, self.attributes, (quest.id, quest.name, quest.tier, quest.description, quest.expires))
 		
 		# Custom
 		def count_active(self) -> int:
@@ -259,6 +909,9 @@ class Tables:
 				results.append(Types.Quest(*quest))
 			return results
 
+		def get_expiry_times(self) -> list:
+			return self.connection.execute("SELECT id, expires FROM Quests", fetch=True)
+
 		def get_expiring(self) -> list:
 			quests = self.connection.execute("SELECT * FROM Quests WHERE expires <= ? ORDER BY expires ASC", (Time.current_timestamp() - (60 * 60 * 24),), fetch=True)
 			results = []
@@ -274,20 +927,88 @@ class Tables:
 			self.connection.create(self.name, self.attributes, (user_id, 0, 0, 0, 0, 0))
 
 		def get(self, user_id: int) -> tuple:
-			return self.connection.get(self.name, user_id, key='user')
+			# Columns are listed so the generated points column is left out
+			try:
+				return self.connection.execute(f"SELECT {','.join(self.attributes)} FROM UserQuests WHERE user = ?", (user_id,), fetch=1)
+			except:
+				raise NotFound(f"Could not find {self.name} entries with key {self.key}.")
 		
 		# Custom
+		def update_points(self, user_id: int, tier: str, amount: int) -> None:
+			# Adds completed quests of a tier, creating the user's row if it doesn't exist yet
+			if tier not in self.attributes[1:]:
+				raise NotFound(f"No column \'{tier}\' in table {self.name}")
+			self.connection.execute(f"INSERT INTO UserQuests (user, {tier}) VALUES (?, ?) ON CONFLICT (user) DO UPDATE SET {tier} = {tier} + excluded.{tier}", (user_id, amount))
+
 		def get_qp(self, user_id: int) -> int:
 			try:
-				return self.connection.execute("SELECT (easy * 1 + normal * 2 + hard * 3 + insane * 4 + extra * 5) FROM UserQuests WHERE user = ?", (user_id,), fetch=1)
+				return self.connection.execute("SELECT points FROM UserQuests WHERE user = ?", (user_id,), fetch=1)
 			except:
 				return 0
 			
 		def qp_rank(self, qp: int) -> int:
 			try:
-				return self.connection.execute("SELECT COUNT(user) FROM UserQuests WHERE easy * 1 + normal * 2 + hard * 3 + insane * 4 + extra * 5 >= ?", (qp,), fetch=1)
+				return self.connection.execute("SELECT COUNT(user) FROM UserQuests WHERE points >= ?", (qp,), fetch=1)
 			except:
 				return 0
 		
 		def qp_ranking(self, offset: int = 0, size: int = 10) -> list:
-			return self.connection.execute("SELECT user, (easy * 1 + normal * 2 + hard * 3 + insane * 4 + extra * 5) AS points FROM UserQuests ORDER BY points DESC LIMIT ? OFFSET ?", (size, offset), fetch=True)
+			# Returns (user id, name, points) tuples
+			return self.connection.execute("SELECT uq.user, u.name, uq.points FROM UserQuests uq LEFT JOIN Users u ON uq.user = u.id ORDER BY uq.points DESC LIMIT ? OFFSET ?", (size, offset), fetch=True)
+
+
+
+class Activity:
+	FLUSH_SIZE = 100  # How many users can be pending before flushing early
+
+	def __init__(self, connection: AsyncConnection, flush_size: int = FLUSH_SIZE) -> None:
+		self.connection = connection
+		self.flush_size = flush_size
+		self.pending = {}  # user id -> [xp gained, last active timestamp]
+		self.flushing = []  # Batches like pending being written, oldest first, kept until they are committed
+
+	def shared(bot) -> 'Activity':
+		# Kept on the bot so whatever replaces the database can drop what was recorded against the old one
+		if not hasattr(bot, 'activity_buffer'):
+			bot.activity_buffer = Activity(AsyncConnection.shared(bot))
+		return bot.activity_buffer
+
+	def apply(self, user: Types.User) -> Types.User:
+		# Overlays changes that have not been written yet onto a user from the database
+		# A user read while a batch is being written may or may not include it, but the active timestamp tells:
+		# xp is only earned 5s after the last activity, so an entry with xp is always later than a row without it
+		for entries in [*self.flushing, self.pending]:
+			if user.id in entries:
+				xp, active = entries[user.id]
+				if user.active is None or active > user.active:
+					user.xp += xp
+					user.active = active
+		return user
+
+	def record(self, user_id: int, active: int, xp: int = 0) -> bool:
+		# Returns True when enough users are pending that it should be flushed
+		entry = self.pending.setdefault(user_id, [0, active])
+		entry[0] += xp
+		entry[1] = active
+		return len(self.pending) >= self.flush_size
+
+	async def flush(self) -> int:
+		if not self.pending:
+			return 0
+		pending, self.pending = self.pending, {}
+		self.flushing.append(pending)
+		try:
+			await self.connection.users.update_activity([(xp, active, _id) for _id, (xp, active) in pending.items()])
+		except:
+			# Put everything back so nothing is lost, newer activity takes priority
+			for _id, (xp, active) in pending.items():
+				entry = self.pending.setdefault(_id, [0, active])
+				entry[0] += xp
+			raise
+		finally:
+			self.flushing.remove(pending)
+		return len(pending)
+
+	def clear(self) -> None:
+		# Drops everything not yet being written, batches already being written are committed before any later write
+		self.pending = {}
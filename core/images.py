@@ -0,0 +1,96 @@
+from PIL import Image, ImageOps, ImageDraw, ImageColor
+from core.common import Data
+from io import BytesIO
+import os
+
+# core/images.py
+# - (BadgeImages) badge images decoded once and kept in memory for profile rendering
+# - (Profile) profile image layout and rendering
+
+class BadgeImages:
+	SIZE = (80, 40)  # Size of a badge slot in the profile image
+
+	def __init__(self, path: str = Data.BADGE_PATH) -> None:
+		self.path = path
+		self.images = {}  # image file name -> RGBA image the size of a badge slot
+		self.loaded = False
+
+	def shared(bot) -> 'BadgeImages':
+		# Kept on the bot so every cog sees the same images, and reloading cogs doesn't decode them again
+		if not hasattr(bot, 'badge_images'):
+			bot.badge_images = BadgeImages()
+		return bot.badge_images
+
+	def decode(self, image: str) -> Image.Image:
+		# Raises if the file is missing, outside the badge folder or not an image
+		path = os.path.realpath(os.path.join(self.path, image))
+		if os.path.commonpath([path, os.path.realpath(self.path)]) != os.path.realpath(self.path):
+			raise ValueError(f"Badge image \'{image}\' is outside of {self.path}")
+		with Image.open(path) as file:
+			decoded = file.convert('RGBA')
+		if decoded.size != BadgeImages.SIZE:
+			decoded = ImageOps.pad(decoded, BadgeImages.SIZE, color=(0, 0, 0, 0))
+		return decoded
+
+	def load(self, image: str) -> None:
+		self.images[image] = self.decode(image)
+
+	def put(self, image: str, decoded: Image.Image) -> None:
+		self.images[image] = decoded
+
+	def load_all(self, images: list) -> None:
+		for image in images:
+			try:
+				self.load(image)
+			except:
+				print(f"Could not load badge image \'{image}\'.")
+		self.loaded = True
+
+	def remove(self, image: str) -> None:
+		self.images.pop(image, None)
+
+	def clear(self) -> None:
+		self.images = {}
+		self.loaded = False
+
+	def missing(self, images: list) -> list:
+		return [image for image in images if image not in self.images]
+
+	def get_many(self, images: list) -> list:
+		return [self.get(image) for image in images]
+
+	def get(self, image: str) -> Image.Image:
+		if image not in self.images:
+			try:
+				self.load(image)
+			except:
+				# An empty slot is drawn rather than failing the whole profile, and the file is tried again next time
+				return Image.new('RGBA', BadgeImages.SIZE, 0)
+		return self.images[image]
+
+class Profile:
+	PADDING = 6
+	BADGE_WIDTH, BADGE_HEIGHT = BadgeImages.SIZE
+	BADGES_PER_ROW = 4
+	XP_HEIGHT = PADDING * 2 + 4
+	IMAGE_WIDTH = BADGES_PER_ROW * (BADGE_WIDTH + PADDING) + PADDING
+
+	def bar_width(xp: int, prev_xp: int, next_xp: int) -> int:
+		return int((Profile.IMAGE_WIDTH - Profile.PADDING)*(xp - prev_xp)/(next_xp - prev_xp))
+
+	def render(badges: list, bar_width: int, color: str) -> bytes:
+		# Returns the encoded PNG, badges are already decoded images (see BadgeImages)
+		# Only uses its arguments so that it can run in another process
+		PADDING, BADGE_WIDTH, BADGE_HEIGHT, BADGES_PER_ROW, XP_HEIGHT, IMAGE_WIDTH = Profile.PADDING, Profile.BADGE_WIDTH, Profile.BADGE_HEIGHT, Profile.BADGES_PER_ROW, Profile.XP_HEIGHT, Profile.IMAGE_WIDTH
+		image = Image.new('RGBA', (IMAGE_WIDTH, int((len(badges) + BADGES_PER_ROW - 1) / BADGES_PER_ROW) * (BADGE_HEIGHT + PADDING) + XP_HEIGHT + PADDING), 0)
+		
+		bar = ImageDraw.Draw(image)
+		bar.rectangle((PADDING, PADDING, IMAGE_WIDTH - PADDING, PADDING + 4), fill=ImageColor.getrgb("#C0C0C0"))
+		bar.rectangle((PADDING, PADDING, PADDING + bar_width, PADDING + 4), fill=ImageColor.getrgb(color))
+		
+		for i in range(len(badges)):
+			image.paste(badges[i], (PADDING + (BADGE_WIDTH + PADDING)*(i % BADGES_PER_ROW), int(i / BADGES_PER_ROW) * (BADGE_HEIGHT + PADDING) + (XP_HEIGHT) + PADDING))
+		
+		buffer = BytesIO()
+		image.save(buffer, format='PNG')
+		return buffer.getvalue()
@@ -0,0 +1,116 @@
+import json
+import math
+import threading
+
+# core/metrics.py
+# - (Histogram) latency histogram with fixed buckets, like Prometheus'
+# - (Metrics) named and labelled histograms and gauges, rendered as Prometheus text or JSON
+
+class Histogram:
+	BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, math.inf)  # Upper bounds in seconds
+
+	def __init__(self) -> None:
+		self.buckets = [0] * len(Histogram.BUCKETS)
+		self.count = 0
+		self.sum = 0.0
+		self.max = 0.0
+
+	def observe(self, seconds: float) -> None:
+		for i, bound in enumerate(Histogram.BUCKETS):
+			if seconds <= bound:
+				self.buckets[i] += 1
+				break
+		self.count += 1
+		self.sum += seconds
+		self.max = max(self.max, seconds)
+
+	def quantile(self, q: float) -> float:
+		# Estimated by interpolating within the bucket the quantile falls in, the same way Prometheus does
+		if not self.count:
+			return 0.0
+		rank = q * self.count
+		seen = 0
+		for i, count in enumerate(self.buckets):
+			if seen + count >= rank and count:
+				lower = Histogram.BUCKETS[i - 1] if i else 0.0
+				upper = Histogram.BUCKETS[i] if Histogram.BUCKETS[i] != math.inf else self.max
+				return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+			seen += count
+		return self.max
+
+	def summary(self) -> dict:
+		return {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else 0.0, "p50": self.quantile(0.5), "p99": self.quantile(0.99), "max": self.max}
+
+class Metrics:
+	def __init__(self) -> None:
+		self.histograms = {}  # (name, labels) -> Histogram, where labels is a sorted tuple of (label, value) pairs
+		self.gauges = {}  # name -> function returning a list of (labels, value) pairs, read when rendered
+		# Database queries are observed from worker threads
+		self.lock = threading.Lock()
+
+	def shared(bot) -> 'Metrics':
+		# Kept on the bot so recorded metrics survive cog reloads
+		if not hasattr(bot, 'metrics'):
+			bot.metrics = Metrics()
+		return bot.metrics
+
+	def observe(self, name: str, seconds: float, **labels) -> None:
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			histogram = self.histograms.get(key)
+			if histogram is None:
+				histogram = self.histograms[key] = Histogram()
+			histogram.observe(seconds)
+
+	def gauge(self, name: str, read) -> None:
+		self.gauges[name] = read
+
+	def clear(self) -> None:
+		with self.lock:
+			self.histograms.clear()
+
+	def snapshot(self) -> dict:
+		with self.lock:
+			histograms = {key: histogram.summary() | {"buckets": list(histogram.buckets)} for key, histogram in self.histograms.items()}
+		gauges = {}
+		for name, read in self.gauges.items():
+			try:
+				gauges[name] = read()
+			except:
+				# A gauge reading something that's gone (i.e. an unloaded cog) is left out rather than failing the rest
+				pass
+		return {"histograms": histograms, "gauges": gauges}
+
+	def escape(value) -> str:
+		return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+	def labels(labels) -> str:
+		if not labels:
+			return ""
+		return "{" + ",".join(f'{label}="{Metrics.escape(value)}"' for label, value in labels) + "}"
+
+	def prometheus(self) -> str:
+		snapshot = self.snapshot()
+		lines = []
+		typed = set()
+		for (name, labels), histogram in sorted(snapshot["histograms"].items()):
+			if name not in typed:
+				lines.append(f"# TYPE {name} histogram")
+				typed.add(name)
+			cumulative = 0
+			for bound, count in zip(Histogram.BUCKETS, histogram["buckets"]):
+				cumulative += count
+				lines.append(f"{name}_bucket{Metrics.labels(labels + (('le', '+Inf' if bound == math.inf else bound),))} {cumulative}")
+			lines.append(f"{name}_sum{Metrics.labels(labels)} {histogram['sum']}")
+			lines.append(f"{name}_count{Metrics.labels(labels)} {histogram['count']}")
+		for name, values in sorted(snapshot["gauges"].items()):
+			lines.append(f"# TYPE {name} gauge")
+			for labels, value in values:
+				lines.append(f"{name}{Metrics.labels(tuple(sorted(labels.items())))} {value}")
+		return "\n".join(lines) + "\n"
+
+	def json(self, timestamp: int) -> str:
+		snapshot = self.snapshot()
+		histograms = [{"name": name, "labels": dict(labels), **histogram} for (name, labels), histogram in snapshot["histograms"].items()]
+		gauges = [{"name": name, "labels": labels, "value": value} for name, values in snapshot["gauges"].items() for labels, value in values]
+		return json.dumps({"timestamp": timestamp, "histograms": histograms, "gauges": gauges})
@@ -0,0 +1,89 @@
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+# core/profiler.py
+# - (Profiler) sampling profiler for every thread of the running process, which only exists while it's profiling
+
+class Profiler:
+	INTERVAL = 0.005  # Seconds between samples
+	SWITCH_INTERVAL = 0.0001  # Seconds between GIL switches while profiling
+	MAX_SECONDS = 120
+	TOP = 40  # Functions listed in each table of the report
+	# Where a thread's top frame is when it's waiting for work, rather than doing any
+	IDLE = {("selectors.py", "select"), ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("queue.py", "get"), ("thread.py", "_worker")}
+	running = threading.Lock()  # Only one profile at a time
+
+	def __init__(self, interval: float = INTERVAL) -> None:
+		self.interval = interval
+		self.rounds = 0  # Times every thread was sampled
+		self.samples = 0
+		self.idle = 0
+		self.cumulative = Counter()  # function -> samples with it anywhere on the stack
+		self.own = Counter()  # function -> samples with it at the top of the stack
+		self.threads = Counter()  # thread name -> busy samples
+
+	def function(frame) -> tuple:
+		code = frame.f_code
+		return (code.co_qualname if hasattr(code, 'co_qualname') else code.co_name, code.co_filename, code.co_firstlineno)
+
+	def sample(self, names: dict, ignore: int) -> None:
+		self.rounds += 1
+		for ident, frame in sys._current_frames().items():
+			if ident == ignore:
+				continue
+			self.samples += 1
+			if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in Profiler.IDLE:
+				self.idle += 1
+				continue
+			self.threads[names.get(ident, str(ident))] += 1
+			self.own[Profiler.function(frame)] += 1
+			# Recursive functions only count once per sample
+			seen = set()
+			while frame is not None:
+				function = Profiler.function(frame)
+				if function not in seen:
+					seen.add(function)
+					self.cumulative[function] += 1
+				frame = frame.f_back
+
+	def run(self, seconds: float) -> str:
+		# Blocks the calling thread while sampling every other thread, then returns the report
+		if not Profiler.running.acquire(blocking=False):
+			raise RuntimeError("Already profiling")
+		# Other threads only let go of the GIL (so a sample can be taken) every switch interval,
+		# which at the default 5ms would hide most of the short bursts of work the event loop does
+		switch_interval = sys.getswitchinterval()
+		sys.setswitchinterval(Profiler.SWITCH_INTERVAL)
+		try:
+			ignore = threading.get_ident()
+			start = time.perf_counter()
+			deadline = start + min(seconds, Profiler.MAX_SECONDS)
+			names = {}
+			while time.perf_counter() < deadline:
+				if self.rounds % 200 == 0:
+					names = {thread.ident: thread.name for thread in threading.enumerate()}
+				self.sample(names, ignore)
+				time.sleep(self.interval)
+			return self.report(time.perf_counter() - start)
+		finally:
+			sys.setswitchinterval(switch_interval)
+			Profiler.running.release()
+
+	def report(self, elapsed: float) -> str:
+		busy = self.samples - self.idle
+		# Sampling itself takes time, so each sample stands for a little more than the interval
+		per_sample = elapsed / self.rounds if self.rounds else self.interval
+		lines = [f"Profiled {elapsed:.1f}s every {self.interval * 1000:g}ms: {self.samples} thread samples, {busy} busy ({self.idle} waiting for work left out)", ""]
+		lines.append("Busy samples by thread")
+		for name, count in self.threads.most_common():
+			lines.append(f"  {count:>7}  {count / busy if busy else 0:>6.1%}  {name}")
+		for title, counter in (("Top functions by cumulative time", self.cumulative), ("Top functions by own time", self.own)):
+			lines.append("")
+			lines.append(title)
+			lines.append(f"  {'samples':>7}  {'busy':>6}  {'~time':>9}  function")
+			for (name, filename, line), count in counter.most_common(Profiler.TOP):
+				lines.append(f"  {count:>7}  {count / busy if busy else 0:>6.1%}  {count * per_sample * 1000:>7.0f}ms  {name} ({os.path.relpath(filename) if filename.startswith(os.getcwd()) else filename}:{line})")
+		return "\n".join(lines) + "\n"
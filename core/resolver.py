@@ -0,0 +1,54 @@
+from core.common import Time
+
+# core/resolver.py
+# - (Resolver) finds guilds, members and channels in the gateway cache before falling back to the API
+
+class Resolver:
+	TTL = 300  # Seconds an object fetched from the API is reused for
+	MAX_FETCHED = 1000  # Fetched objects kept before expired ones are cleared out
+
+	def __init__(self, bot) -> None:
+		self.bot = bot
+		self.fetched = {}  # (kind, id) -> (expires timestamp, object)
+		# kind -> [found in gateway cache, reused from fetched, fetched from the API]
+		self.counts = {"guild": [0, 0, 0], "member": [0, 0, 0], "channel": [0, 0, 0]}
+
+	def shared(bot) -> 'Resolver':
+		# Kept on the bot so fetched objects and counts survive cog reloads
+		if not hasattr(bot, 'resolver'):
+			bot.resolver = Resolver(bot)
+		return bot.resolver
+
+	async def resolve(self, kind: str, _id: int, cached, fetch):
+		found = cached()
+		if found is not None:
+			self.counts[kind][0] += 1
+			return found
+		now = Time.current_timestamp()
+		expires, found = self.fetched.get((kind, _id), (0, None))
+		if expires > now:
+			self.counts[kind][1] += 1
+			return found
+		self.counts[kind][2] += 1
+		found = await fetch()
+		if len(self.fetched) >= Resolver.MAX_FETCHED:
+			self.fetched = {key: value for key, value in self.fetched.items() if value[0] > now}
+		self.fetched[(kind, _id)] = (now + Resolver.TTL, found)
+		return found
+
+	async def guild(self, guild_id: int):
+		return await self.resolve("guild", guild_id, lambda: self.bot.get_guild(guild_id), lambda: self.bot.fetch_guild(guild_id))
+
+	async def member(self, guild, member_id: int):
+		# Raises discord.NotFound (or similar) when the member can't be found at all, just like fetch_member
+		return await self.resolve("member", (guild.id, member_id), lambda: guild.get_member(member_id) if isinstance(member_id, int) else None, lambda: guild.fetch_member(member_id))
+
+	async def channel(self, channel_id: int):
+		return await self.resolve("channel", channel_id, lambda: self.bot.get_channel(channel_id), lambda: self.bot.fetch_channel(channel_id))
+
+	def stats(self) -> dict:
+		stats = {}
+		for kind, (gateway, reused, fetched) in self.counts.items():
+			total = gateway + reused + fetched
+			stats[kind] = {"gateway": gateway, "reused": reused, "fetched": fetched, "hit_rate": (gateway + reused) / total if total else 0}
+		return stats
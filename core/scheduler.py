@@ -0,0 +1,69 @@
+from core.common import Time
+import asyncio
+import heapq
+
+# core/scheduler.py
+# - (ExpiryScheduler) min-heap of deadlines that sleeps until the next one is due
+
+class ExpiryScheduler:
+	def __init__(self) -> None:
+		self.heap = []  # (deadline, id), may hold stale entries for rescheduled or cancelled ids
+		self.deadlines = {}  # id -> current deadline
+		self.changed = asyncio.Event()
+
+	def shared(bot, name: str) -> 'ExpiryScheduler':
+		# Kept on the bot so the cog scheduling deadlines and the cog waiting on them see the same heap
+		if not hasattr(bot, 'schedulers'):
+			bot.schedulers = {}
+		if name not in bot.schedulers:
+			bot.schedulers[name] = ExpiryScheduler()
+		return bot.schedulers[name]
+
+	def schedule(self, _id, deadline: int) -> None:
+		# Rescheduling an id only adds a new entry, the old one is skipped once it reaches the top
+		self.deadlines[_id] = deadline
+		heapq.heappush(self.heap, (deadline, _id))
+		self.changed.set()
+
+	def cancel(self, _id) -> None:
+		self.deadlines.pop(_id, None)
+
+	def clear(self) -> None:
+		self.heap.clear()
+		self.deadlines.clear()
+		self.changed.set()
+
+	def __len__(self) -> int:
+		return len(self.deadlines)
+
+	def next(self) -> int:
+		# Earliest current deadline, dropping stale entries on the way
+		while self.heap:
+			deadline, _id = self.heap[0]
+			if self.deadlines.get(_id) == deadline:
+				return deadline
+			heapq.heappop(self.heap)
+		return None
+
+	def pop_due(self, now: int) -> list:
+		due = []
+		while (deadline := self.next()) is not None and deadline <= now:
+			deadline, _id = heapq.heappop(self.heap)
+			del self.deadlines[_id]
+			due.append(_id)
+		return due
+
+	async def wait(self) -> list:
+		# Sleeps until at least one deadline is due and returns every id due by then
+		while True:
+			self.changed.clear()
+			deadline = self.next()
+			if deadline is not None:
+				due = self.pop_due(Time.current_timestamp())
+				if due:
+					return due
+			try:
+				# Woken early whenever something is scheduled, as it may be due before the current deadline
+				await asyncio.wait_for(self.changed.wait(), None if deadline is None else max(deadline - Time.current_timestamp(), 0))
+			except asyncio.TimeoutError:
+				pass
@@ -0,0 +1,50 @@
+from core.common import Time
+from core.backups import BackupStore
+import asyncio
+import os
+
+# core/stats.py
+# - (Stats) database and disk statistics, with the expensive parts cached for a short time
+
+class Stats:
+	TTL = 60  # Seconds row counts and the backup folder size are reused for
+
+	def __init__(self, database, backups: str = BackupStore.PATH) -> None:
+		self.database = database
+		self.backups = backups
+		self.cached = {}  # name -> (expires timestamp, value)
+
+	def shared(bot) -> 'Stats':
+		# Kept on the bot so cached statistics survive cog reloads
+		if not hasattr(bot, 'stats'):
+			bot.stats = Stats(bot.database)
+		return bot.stats
+
+	def folder_size(path: str) -> int:
+		size = 0
+		for directory, directories, files in os.walk(path):
+			for file in files:
+				try:
+					size += os.path.getsize(os.path.join(directory, file))
+				except OSError:
+					# Removed while walking, i.e. by backup cleanup
+					pass
+		return size
+
+	async def __cached__(self, name: str, load):
+		now = Time.current_timestamp()
+		expires, value = self.cached.get(name, (0, None))
+		if expires <= now:
+			value = await load()
+			self.cached[name] = (now + Stats.TTL, value)
+		return value
+
+	async def get(self) -> dict:
+		# Page counts come from the database header so they're always current, everything else may be up to TTL old
+		storage = await self.database.read(lambda connection: connection.storage())
+		counts = await self.__cached__("counts", lambda: self.database.read(lambda connection: connection.count_all()))
+		backups = await self.__cached__("backups", lambda: asyncio.to_thread(Stats.folder_size, self.backups))
+		return {**storage, "counts": counts, "backup_bytes": backups, "fragmentation": storage["freelist_count"] / storage["page_count"] if storage["page_count"] else 0}
+
+	def invalidate(self) -> None:
+		self.cached.clear()
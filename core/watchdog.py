@@ -0,0 +1,107 @@
+from collections import Counter
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+# core/watchdog.py
+# - (LoopWatchdog) notices when the event loop is blocked and records where, grouped by call site
+
+class LoopWatchdog:
+	INTERVAL = 0.05  # Seconds between heartbeats from the loop, and between checks on them
+	THRESHOLD = 0.1  # Seconds the loop has to go without a heartbeat to count as blocked
+	STACK_DEPTH = 12  # Frames kept of the stack that was blocking
+	ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+	def __init__(self, threshold: float = THRESHOLD) -> None:
+		self.threshold = threshold
+		self.beat = time.monotonic()
+		self.loop_thread = None
+		self.task = None
+		self.thread = None
+		self.stopping = threading.Event()
+		self.sites = {}  # call site -> {"count", "total", "max", "last", "stack"}
+		# Stalls are recorded by the watchdog thread and read from the loop
+		self.lock = threading.Lock()
+
+	def shared(bot) -> 'LoopWatchdog':
+		# Kept on the bot so recorded stalls survive cog reloads
+		if not hasattr(bot, 'watchdog'):
+			bot.watchdog = LoopWatchdog(float(os.environ.get("WATCHDOG_THRESHOLD", LoopWatchdog.THRESHOLD)))
+		return bot.watchdog
+
+	def start(self) -> None:
+		# Called from the event loop being watched
+		self.loop_thread = threading.get_ident()
+		self.beat = time.monotonic()
+		# Each watching thread gets its own event, so one still winding down after a stop can't carry on after a start
+		self.stopping = threading.Event()
+		self.task = asyncio.create_task(self.heartbeat())
+		self.thread = threading.Thread(target=self.watch, args=(self.stopping,), name="loop-watchdog", daemon=True)
+		self.thread.start()
+
+	def stop(self) -> None:
+		self.stopping.set()
+		if self.task:
+			self.task.cancel()
+
+	async def heartbeat(self) -> None:
+		while True:
+			self.beat = time.monotonic()
+			await asyncio.sleep(LoopWatchdog.INTERVAL)
+
+	def site(self, frame) -> tuple:
+		# The innermost frame in this project's own code is the call site to blame, even if the time is spent deeper in a library
+		stack = traceback.extract_stack(frame)
+		site = stack[-1]
+		for entry in reversed(stack):
+			if entry.filename.startswith(LoopWatchdog.ROOT) and 'site-packages' not in entry.filename:
+				site = entry
+				break
+		filename = os.path.relpath(site.filename, LoopWatchdog.ROOT) if site.filename.startswith(LoopWatchdog.ROOT) else site.filename
+		return f"{filename}:{site.lineno} ({site.name})", "".join(traceback.format_list(stack[-LoopWatchdog.STACK_DEPTH:]))
+
+	def watch(self, stopping: threading.Event) -> None:
+		stall = None  # The stall in progress: heartbeat it started after, how long it's lasted so far, sites and stacks seen
+		while not stopping.wait(LoopWatchdog.INTERVAL):
+			beat = self.beat
+			blocked = time.monotonic() - beat - LoopWatchdog.INTERVAL
+			if stall is not None and stall["beat"] != beat:
+				# The loop got to run its heartbeat again, so the stall is over
+				self.record(stall, max(beat - stall["beat"] - LoopWatchdog.INTERVAL, stall["blocked"]))
+				stall = None
+			if blocked < self.threshold:
+				continue
+			frame = sys._current_frames().get(self.loop_thread)
+			if frame is None:
+				continue
+			if stall is None:
+				stall = {"beat": beat, "blocked": blocked, "sites": Counter(), "stacks": {}}
+			site, stack = self.site(frame)
+			stall["blocked"] = blocked
+			stall["sites"][site] += 1
+			stall["stacks"][site] = stack
+			del frame
+
+	def record(self, stall: dict, seconds: float) -> None:
+		# A stall is blamed on wherever the loop was found stuck most often while it lasted
+		site = stall["sites"].most_common(1)[0][0]
+		with self.lock:
+			entry = self.sites.setdefault(site, {"count": 0, "total": 0.0, "max": 0.0, "last": 0, "stack": ""})
+			entry["count"] += 1
+			entry["total"] += seconds
+			entry["max"] = max(entry["max"], seconds)
+			entry["last"] = int(time.time())
+			entry["stack"] = stall["stacks"][site]
+		print(f"WATCHDOG > Event loop blocked for {seconds * 1000:.0f}ms at {site}")
+
+	def report(self) -> list:
+		# (site, stats) pairs, most time blocked first
+		with self.lock:
+			return sorted(((site, dict(entry)) for site, entry in self.sites.items()), key=lambda item: item[1]["total"], reverse=True)
+
+	def clear(self) -> None:
+		with self.lock:
+			self.sites.clear()